@@ -1,15 +1,25 @@
 """Authentication utilities."""
-from datetime import datetime, timedelta
+import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+import hashlib
+import hmac
+import json
 import os
-from passlib.context import CryptContext
-from typing import Optional, Union
+import threading
+import time
+from typing import List, Optional, Tuple, Union
 
+import bcrypt
 from fastapi import HTTPException
 from fastapi.openapi.models import OAuthFlows as OAuthFlowsModel
 from fastapi.security import OAuth2
 from fastapi.security.base import SecurityBase
-from fastapi.security.utils import get_authorization_scheme_param
 import jwt
+import orjson
+from starlette.concurrency import run_in_threadpool
 from starlette.status import HTTP_403_FORBIDDEN
 from starlette.requests import Request
 
@@ -21,14 +31,60 @@ import models
 SECRET_KEY = os.environ.get("RUNNING_APP_SECRET_KEY", "REPLACE_ME")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # one week
+DEFAULT_EXPIRE_SECONDS = 15 * 60
+BCRYPT_ROUNDS = 12
+VERIFICATION_CACHE_SIZE = 1024
+VERIFICATION_CACHE_TTL_SECONDS = 30
+ACCESS_TOKEN_CACHE_SIZE = 4096
+
+
+def base64url_encode(data: bytes) -> bytes:
+    """Unpadded URL-safe base64 encoding, as used by JWTs."""
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+# the header and signing key are the same for every token, so prepare them once
+_SECRET_KEY_BYTES = SECRET_KEY.encode("utf-8")
+_encoded_header = base64url_encode(
+    json.dumps({"alg": ALGORITHM, "typ": "JWT"}, separators=(",", ":")).encode("utf-8")
+)
+# keyed HMAC-SHA256 state, copied per token to skip re-deriving the key pads
+_hmac_prototype = hmac.new(_SECRET_KEY_BYTES, digestmod=hashlib.sha256)
+
+AUTHORIZATION = "Authorization"
+BEARER_PREFIX = "Bearer "
+BASIC_PREFIX = "Basic "
+
+
+def has_scheme(authorization: str, prefix: str) -> bool:
+    """Whether an Authorization value starts with a scheme prefix, ignoring case.
+
+    The canonical spelling is checked first so the common case does not
+    allocate a lowercased copy of the prefix.
+    """
+    return (
+        authorization.startswith(prefix)
+        or authorization[: len(prefix)].lower() == prefix.lower()
+    )
+
+
+def extract_bearer_token(authorization: Optional[str]) -> Optional[str]:
+    """Get the token from a bearer Authorization value, if it is one.
+
+    Only the token is needed, so the scheme prefix is checked directly rather
+    than splitting the whole value into scheme and parameter.
+    """
+    if authorization and has_scheme(authorization, BEARER_PREFIX):
+        return authorization[len(BEARER_PREFIX) :]
+    return None
 
 
 class OAuth2PasswordBearerCookie(OAuth2):
     def __init__(
         self,
         tokenUrl: str,
-        scheme_name: str = None,
-        scopes: dict = None,
+        scheme_name: Optional[str] = None,
+        scopes: Optional[dict] = None,
         auto_error: bool = True,
     ):
         if not scopes:
@@ -37,95 +93,220 @@ class OAuth2PasswordBearerCookie(OAuth2):
         super().__init__(flows=flows, scheme_name=scheme_name, auto_error=auto_error)
 
     async def __call__(self, request: Request) -> Optional[str]:
-        header_authorization: str = request.headers.get("Authorization")
-        cookie_authorization: str = request.cookies.get("Authorization")
-
-        header_scheme, header_param = get_authorization_scheme_param(
-            header_authorization
-        )
-        cookie_scheme, cookie_param = get_authorization_scheme_param(
-            cookie_authorization
-        )
+        # cookies are only parsed when the header did not authenticate
+        token: Optional[str] = extract_bearer_token(request.headers.get(AUTHORIZATION))
+        if token is None:
+            token = extract_bearer_token(request.cookies.get(AUTHORIZATION))
 
-        if header_scheme.lower() == "bearer":
-            authorization = True
-            scheme = header_scheme
-            param = header_param
-
-        elif cookie_scheme.lower() == "bearer":
-            authorization = True
-            scheme = cookie_scheme
-            param = cookie_param
-
-        else:
-            authorization = False
-
-        if not authorization or scheme.lower() != "bearer":
-            if self.auto_error:
-                raise HTTPException(
-                    status_code=HTTP_403_FORBIDDEN, detail="Not authenticated"
-                )
-            else:
-                return None
-        return param
+        if token is None and self.auto_error:
+            raise HTTPException(
+                status_code=HTTP_403_FORBIDDEN, detail="Not authenticated"
+            )
+        return token
 
 
 class BasicAuth(SecurityBase):
-    def __init__(self, scheme_name: str = None, auto_error: bool = True):
+    def __init__(self, scheme_name: Optional[str] = None, auto_error: bool = True):
         self.scheme_name = scheme_name or self.__class__.__name__
         self.auto_error = auto_error
 
     async def __call__(self, request: Request) -> Optional[str]:
-        authorization: str = request.headers.get("Authorization")
-        scheme, param = get_authorization_scheme_param(authorization)
-        if not authorization or scheme.lower() != "basic":
+        authorization: Optional[str] = request.headers.get(AUTHORIZATION)
+        if not authorization or not has_scheme(authorization, BASIC_PREFIX):
             if self.auto_error:
                 raise HTTPException(
                     status_code=HTTP_403_FORBIDDEN, detail="Not authenticated"
                 )
             else:
                 return None
-        return param
+        return authorization[len(BASIC_PREFIX) :]
 
 
 basic_auth = BasicAuth(auto_error=False)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearerCookie(tokenUrl="/login", auto_error=False)
 
+# digest of (hashed password, password) -> (expiry time, verification result)
+_verification_cache: "OrderedDict[bytes, Tuple[float, bool]]" = OrderedDict()
+_verification_cache_lock = threading.Lock()
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password matches the hashed version for a the user.
+
+    Results are cached for a short time so that bursts of identical login
+    attempts only pay for bcrypt once. The cache is keyed on a digest so raw
+    passwords are never stored.
+    """
+    plain_bytes = plain_password.encode("utf-8")
+    hashed_bytes = hashed_password.encode("utf-8")
+    key = hashlib.sha256(hashed_bytes + b"\x00" + plain_bytes).digest()
+
+    now = time.monotonic()
+    with _verification_cache_lock:
+        cached = _verification_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
 
-def verify_password(plain_password, hashed_password):
-    """Verify a password matches the hashed version for a the user."""
-    return pwd_context.verify(plain_password, hashed_password)
+    verified = bcrypt.checkpw(plain_bytes, hashed_bytes)
+    with _verification_cache_lock:
+        _verification_cache[key] = (now + VERIFICATION_CACHE_TTL_SECONDS, verified)
+        _verification_cache.move_to_end(key)
+        while len(_verification_cache) > VERIFICATION_CACHE_SIZE:
+            _verification_cache.popitem(last=False)
+    return verified
 
 
-def get_password_hash(password):
+def get_password_hash(password: str) -> str:
     """Get the hash of a password."""
-    return pwd_context.hash(password)
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
 
 
-def authenticate_user(
+# verified against for unknown users, precomputed so neither requests nor imports
+# pay for hashing it, with the same cost as BCRYPT_ROUNDS so timings match
+_DUMMY_PASSWORD_HASH = "$2b$12$JAjxDEKHdk39jfyGhgMCkuC5CAK1oiiqkETcLKy/NEAFB9A1z3JQi"
+
+
+def verify_passwords(
+    pairs: List[Tuple[str, str]], max_workers: Optional[int] = None
+) -> List[bool]:
+    """Verify many (plain password, hashed password) pairs in parallel.
+
+    Intended for bulk jobs such as imports or migrations. bcrypt releases the GIL
+    while hashing, so a pool of threads spreads the work over every core. Unlike
+    forked processes, threads can't inherit a lock held by another thread.
+    """
+    if not pairs:
+        return []
+
+    max_workers = max_workers or os.cpu_count() or 1
+    plain_passwords, hashed_passwords = zip(*pairs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(verify_password, plain_passwords, hashed_passwords))
+
+
+async def authenticate_user(
     db: RunningDatabase, username: str, password: str
 ) -> Union[bool, models.CurrentUser]:
-    """Authenticate a user."""
-    user = db.get_user(username)
+    """Authenticate a user.
+
+    Looking up the user and verifying the password block, so are run in the
+    threadpool rather than on the event loop. A hash is verified even for unknown
+    users so that both failure paths take the same time.
+    """
+    user = await run_in_threadpool(db.get_user, username)
     if not user:
-        # no user with this username was found
+        # no user with this username was found, but still verify against a
+        # dummy hash so response times don't reveal which usernames exist
+        await run_in_threadpool(verify_password, password, _DUMMY_PASSWORD_HASH)
         return False
-    if not verify_password(password, user.hashed_password):
+    verified = await run_in_threadpool(
+        verify_password, password, user.hashed_password
+    )
+    if not verified:
         # username exists but password was incorrect
         return False
     return user
 
 
-def create_access_token(*, data: dict, expires_delta: Optional[timedelta] = None):
-    """Create an secure access token for an authenticated user."""
-    to_encode = data.copy()
+def _needs_json_escaping(value: str) -> bool:
+    """Whether a string can't be written verbatim inside JSON quotes."""
+    return (
+        not value.isascii()
+        or not value.isprintable()
+        or '"' in value
+        or "\\" in value
+    )
+
+
+def _encode_claims(claims: dict) -> bytes:
+    """Serialise token claims to compact JSON.
+
+    Tokens are almost always just a username subject plus an expiry, so that
+    shape is written from a byte template. Anything else goes through orjson.
+    """
+    subject = claims.get("sub")
+    expiry = claims.get("exp")
+    if (
+        len(claims) == 2
+        and type(subject) is str
+        and type(expiry) is int
+        and not _needs_json_escaping(subject)
+    ):
+        return (
+            b'{"sub":"'
+            + subject.encode("ascii")
+            + b'","exp":'
+            + str(expiry).encode("ascii")
+            + b"}"
+        )
+    return orjson.dumps(claims)
+
+
+def _expiry_seconds(expires_delta: Optional[timedelta]) -> int:
+    """Lifetime of a new token in seconds."""
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+        return int(expires_delta.total_seconds())
+    return DEFAULT_EXPIRE_SECONDS
+
+
+def _sign_claims(claims: dict) -> str:
+    """Encode claims as a signed HS256 token."""
+    encoded_payload = base64url_encode(_encode_claims(claims))
+    signing_input = _encoded_header + b"." + encoded_payload
+    # HS256 is just HMAC-SHA256 over the encoded header and payload
+    mac = _hmac_prototype.copy()
+    mac.update(signing_input)
+    signature = base64url_encode(mac.digest())
+    return (signing_input + b"." + signature).decode("utf-8")
+
+
+def create_access_token(
+    *, data: dict, expires_delta: Optional[timedelta] = None, _mutate: bool = False
+) -> str:
+    """Create an secure access token for an authenticated user.
+
+    Callers that build `data` just for this call can pass `_mutate=True` to
+    have the expiry written into it directly instead of into a copy.
+    """
+    to_encode = data if _mutate else data.copy()
+    # JWT expiry is a unix timestamp, so skip datetime objects entirely
+    to_encode["exp"] = int(time.time()) + _expiry_seconds(expires_delta)
+    return _sign_claims(to_encode)
+
+
+def create_access_tokens(
+    datas: List[dict], expires_delta: Optional[timedelta] = None
+) -> List[str]:
+    """Create access tokens for many users at once, e.g. after a bulk import.
+
+    All tokens in the batch share the same expiry time.
+    """
+    expiry = int(time.time()) + _expiry_seconds(expires_delta)
+    return [_sign_claims({**data, "exp": expiry}) for data in datas]
+
+
+@lru_cache(maxsize=ACCESS_TOKEN_CACHE_SIZE)
+def _decode_access_token(token: str) -> dict:
+    """Decode and verify the signature of an access token."""
+    return jwt.decode(token, _SECRET_KEY_BYTES, algorithms=[ALGORITHM])
+
+
+def verify_access_token(token: str) -> dict:
+    """Get the claims of a valid access token.
+
+    Tokens are presented on every request for up to a week, so verified claims
+    are memoised by token. Expiry must then be re-checked on each call since
+    a cached token can expire after it was first verified.
+
+    Raises
+    ------
+    jwt.PyJWTError
+        If the token is invalid or has expired.
+    """
+    payload = _decode_access_token(token)
+    if "exp" in payload and payload["exp"] <= time.time():
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    # copied so callers can't change the claims cached for later requests
+    return dict(payload)
@@ -1,13 +1,21 @@
 """Backend database.
 """
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import lru_cache
-import json
+import logging
 import os
+import pickle
 import sqlite3
-from typing import Dict, List, Optional, Union
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 import uuid
 
+import networkx as nx
 from networkx.readwrite import json_graph
+import orjson
+import zstandard
 
 import exceptions
 from models import (
@@ -17,8 +25,91 @@ from models import (
     SegmentCollection,
     RunArea,
     SubRunArea,
+    UserContext,
 )
 
+logger = logging.getLogger(__name__)
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ZSTD_LEVEL = 3
+# highest protocol supported by python 3.7
+PICKLE_PROTOCOL = 4
+PICKLE_MAGIC = b"\x80"
+GRAPH_CACHE_SIZE = 16
+# graphs are stored once per area, so can be held for a while without a lookup
+GRAPH_CACHE_TTL_SECONDS = 600
+USER_CACHE_SIZE = 1024
+# users are looked up on every request, and other processes may change them
+USER_CACHE_TTL_SECONDS = 5
+
+
+def compress(data: bytes) -> bytes:
+    """Compress serialised data for storage."""
+    # compressor objects are not thread safe, so make one per call
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def decompress(raw: Union[bytes, str]) -> Union[bytes, str]:
+    """Decompress data stored by `compress`, leaving uncompressed data as it is."""
+    if isinstance(raw, bytes) and raw.startswith(ZSTD_MAGIC):
+        return zstandard.ZstdDecompressor().decompress(raw)
+    return raw
+
+
+def compress_json(value) -> bytes:
+    """Serialise a value to JSON and compress it for storage."""
+    return compress(orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY))
+
+
+def decompress_json(raw: Union[bytes, str]):
+    """Load JSON stored by `compress_json`, or stored uncompressed previously."""
+    return orjson.loads(decompress(raw))
+
+
+@lru_cache(maxsize=32)
+def _parse_graph(raw_graph: Union[bytes, str]) -> nx.Graph:
+    """Load a networkx graph as stored.
+
+    Graphs are stored pickled, so loading them needs no graph building. Those
+    stored by earlier versions are node-link JSON and are built from that.
+
+    Keyed on the stored content itself, so an updated graph can never be served
+    from a stale entry, and areas that are switched between stay cached.
+    """
+    data = decompress(raw_graph)
+    if isinstance(data, bytes) and data.startswith(PICKLE_MAGIC):
+        return pickle.loads(data)
+    return json_graph.node_link_graph(orjson.loads(data))
+
+
+class TTLCache(object):
+    """Thread safe LRU cache whose entries expire after a fixed time."""
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get an unexpired value, or None if there isn't one."""
+        with self._lock:
+            cached = self._entries.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
 
 class RunningDatabase(object):
     """Stores runs created in the app."""
@@ -29,17 +120,19 @@ class RunningDatabase(object):
                 ("username", "text", "NOT NULL"),
                 ("hashed_password", "text", "NOT NULL"),
             ],
+            "unique_indexes": [["username"]],
         },
         "run_areas": {
             "schema": [
                 ("username", "text", "NOT NULL"),
                 ("area_name", "text", "NOT NULL"),
                 ("polygon", "text", "NOT NULL"),
-                ("graph", "text", "NULL"),
-                ("geometry", "text", "NULL"),
+                ("graph", "blob", "NULL"),
+                ("geometry", "blob", "NULL"),
                 ("active", "integer", "NOT NULL"),
             ],
-            "index": ["username", "name"],
+            "indexes": [["username", "area_name", "active"]],
+            "unique_indexes": [["username", "area_name"]],
         },
         "sub_run_areas": {
             "schema": [
@@ -48,11 +141,11 @@ class RunningDatabase(object):
                 ("sub_area_name", "text", "NOT NULL"),
                 ("polygon", "text", "NOT NULL"),
             ],
-            "index": ["username", "area_name"],
+            "unique_indexes": [["username", "area_name", "sub_area_name"]],
         },
         "logged_runs": {
             "schema": [
-                ("id", "uuid", "NOT NULL"),
+                ("id", "blob", "NOT NULL"),
                 ("username", "text", "NOT NULL"),
                 ("area_name", "text", "NOT NULL"),
                 ("date", "date", "NOT NULL"),
@@ -61,15 +154,25 @@ class RunningDatabase(object):
                 ("comments", "text", "NULL"),
                 ("linestring", "text", "NULL"),
             ],
-            "index": ["id"],
+            "indexes": [["id"], ["username", "area_name", "date"]],
         },
         "segment_traversals": {
             "schema": [
-                ("run_id", "uuid", "NOT NULL"),
+                ("run_id", "blob", "NOT NULL"),
                 ("segment_id", "text", "NOT NULL"),
                 ("traversals", "int", "NOT NULL"),
             ],
-            "index": ["run_id"],
+            "indexes": [["run_id"], ["segment_id"]],
+        },
+        "run_bounds": {
+            "schema": [
+                ("run_id", "blob", "NOT NULL"),
+                ("min_lat", "float", "NOT NULL"),
+                ("min_lng", "float", "NOT NULL"),
+                ("max_lat", "float", "NOT NULL"),
+                ("max_lng", "float", "NOT NULL"),
+            ],
+            "indexes": [["run_id"]],
         },
         "ignored_segments": {
             "schema": [
@@ -77,43 +180,221 @@ class RunningDatabase(object):
                 ("area_name", "text", "NOT NULL"),
                 ("segment_id", "text", "NOT NULL"),
             ],
-            "index": ["username", "area_name"],
+            "unique_indexes": [["username", "area_name", "segment_id"]],
         },
     }
 
+    # applied once to each new connection
+    pragmas = """
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -64000;
+        PRAGMA mmap_size = 30000000000;
+        PRAGMA busy_timeout = 5000;
+    """
+    writer_pragmas = """
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+    """
+    reader_pragmas = """
+        PRAGMA query_only = 1;
+    """
+
+    # databases whose schema has been created by this process
+    _created_paths = set()
+
+    # removing a run area clears its data from every other table, where segment
+    # traversals and bounds are found via the area's runs so go first
+    triggers = {
+        "run_areas_delete": """
+            AFTER DELETE ON run_areas
+            BEGIN
+                DELETE FROM segment_traversals
+                WHERE run_id IN (
+                    SELECT id
+                    FROM logged_runs
+                    WHERE username = OLD.username
+                        AND area_name = OLD.area_name
+                );
+                DELETE FROM run_bounds
+                WHERE run_id IN (
+                    SELECT id
+                    FROM logged_runs
+                    WHERE username = OLD.username
+                        AND area_name = OLD.area_name
+                );
+                DELETE FROM sub_run_areas
+                WHERE username = OLD.username AND area_name = OLD.area_name;
+                DELETE FROM ignored_segments
+                WHERE username = OLD.username AND area_name = OLD.area_name;
+                DELETE FROM logged_runs
+                WHERE username = OLD.username AND area_name = OLD.area_name;
+            END
+        """,
+    }
+
     def __init__(self, name: str = "running", clean: bool = False, create: bool = True):
         self.name = name
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        # keyed by (username, area_name)
+        self._graph_cache = TTLCache(GRAPH_CACHE_SIZE, GRAPH_CACHE_TTL_SECONDS)
+        # keyed by username
+        self._user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
         if clean:
             self.clean()
-        if not self.exists():
+        path = os.path.abspath(f"{self.name}.db")
+        if path not in self._created_paths:
+            # existing databases also pick up any tables or indexes added since
             self.create()
+            self._created_paths.add(path)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """The single connection used for writes, opened on first use.
+
+        It is shared between threads, with writes serialised by a lock in `execute`
+        and `transaction` rather than by SQLite's busy retries.
+        """
+        if self._writer is None:
+            with self._write_lock:
+                if self._writer is None:
+                    conn = self._connect(f"{self.name}.db", check_same_thread=False)
+                    conn.executescript(self.writer_pragmas)
+                    self._writer = conn
+        return self._writer
 
     @property
-    def db(self):
-        """Connect to the database."""
-        return sqlite3.connect(f"{self.name}.db")
+    def reader(self) -> sqlite3.Connection:
+        """Read-only connection to the database for the current thread.
+
+        Each thread opens its own on first use and keeps it, so reads on different
+        threads run concurrently under WAL. A thread's connection is closed when
+        the thread exits.
+        """
+        conn = getattr(self._local, "reader", None)
+        if conn is None:
+            # the writer creates the database file and puts it in WAL mode
+            self.db
+            conn = self._connect(f"file:{self.name}.db?mode=ro", uri=True)
+            conn.executescript(self.reader_pragmas)
+            self._local.reader = conn
+        return conn
+
+    def _connect(self, database: str, **kwargs) -> sqlite3.Connection:
+        """Open and configure a new connection.
+
+        The connection is in autocommit mode so reads never open a transaction.
+        """
+        conn = sqlite3.connect(database, isolation_level=None, **kwargs)
+        conn.executescript(self.pragmas)
+        # rows can be unpacked like tuples or accessed by column name
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def close(self) -> None:
+        """Close the writer and the current thread's reader if they are open."""
+        conn = getattr(self._local, "reader", None)
+        if conn is not None:
+            conn.close()
+            self._local.reader = None
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed queries in a single transaction.
+
+        Commits once on success and rolls everything back on error. Nested uses
+        join the outermost transaction. All queries in the transaction, including
+        reads, use the writer so they see its uncommitted changes.
+        """
+        with self._write_lock:
+            conn = self.db
+            if conn.in_transaction:
+                # only this thread can be in a transaction while it holds the lock
+                yield
+                return
+            # also take SQLite's write lock up front, in case of other processes
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.in_transaction = True
+            try:
+                yield
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.in_transaction = False
+            conn.commit()
+
+    @staticmethod
+    def _is_read(query: str) -> bool:
+        """Whether a query only reads, so can use a read-only connection."""
+        return query.lstrip()[:6].upper() == "SELECT"
 
     def execute(
         self, query, query_params=None, expect_data=False, many=False, one=False
     ):
-        """Execute a query."""
-        conn = self.db
+        """Execute a query.
+
+        Reads outside of a transaction use the current thread's reader, everything
+        else goes through the writer.
+
+        Returns the fetched rows if `expect_data`, otherwise the number of rows
+        modified.
+        """
+        if query_params is None:
+            query_params = ()
+        if self._is_read(query) and not getattr(self._local, "in_transaction", False):
+            return self._execute(
+                self.reader, query, query_params, expect_data, many, one
+            )
+        with self._write_lock:
+            return self._execute(self.db, query, query_params, expect_data, many, one)
+
+    def iterate(self, query, query_params=None) -> Iterator[sqlite3.Row]:
+        """Lazily yield the rows of a read query.
+
+        Rows come from a dedicated read-only connection which is closed once they
+        are exhausted, so they can be consumed from any thread, e.g. while a
+        response is streamed.
+        """
         if query_params is None:
             query_params = ()
+        # the writer creates the database file and puts it in WAL mode
+        self.db
+        conn = self._connect(
+            f"file:{self.name}.db?mode=ro", uri=True, check_same_thread=False
+        )
+        try:
+            conn.executescript(self.reader_pragmas)
+            yield from conn.execute(query, query_params)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _execute(conn, query, query_params, expect_data, many, one):
+        """Execute a query on a specific connection."""
+        cursor = conn.cursor()
         try:
-            cursor = conn.cursor()
             executor = cursor.executemany if many else cursor.execute
             executor(query, query_params)
             if expect_data:
                 fetcher = cursor.fetchone if one else cursor.fetchall
                 return fetcher()
+            return cursor.rowcount
         finally:
             cursor.close()
-            conn.commit()
-            conn.close()
 
-    def create(self):
-        """Create database and tables."""
+    def schema_statements(self) -> List[str]:
+        """DDL to create any tables, indexes and triggers which do not exist yet.
+
+        Indexes are named after their table and columns. Those from older versions
+        were all named `<table>_run_id`, so are replaced.
+        """
+        statements = []
         for table_name, table_info in self.tables.items():
             formatted_schema = ",".join(
                 [
@@ -121,23 +402,48 @@ class RunningDatabase(object):
                     for column, dtype, nullable in table_info["schema"]
                 ]
             )
-            create_query = f"CREATE TABLE {table_name} ({formatted_schema})"
-            try:
-                self.execute(create_query)
-            except sqlite3.OperationalError:
-                pass
+            statements.append(
+                f"CREATE TABLE IF NOT EXISTS {table_name} ({formatted_schema})"
+            )
+            statements.append(f"DROP INDEX IF EXISTS {table_name}_run_id")
+            for unique, key in (("", "indexes"), ("UNIQUE ", "unique_indexes")):
+                for columns in table_info.get(key, []):
+                    index_name = "_".join([table_name] + columns)
+                    statements.append(
+                        f"CREATE {unique}INDEX IF NOT EXISTS {index_name} "
+                        f"ON {table_name}({', '.join(columns)})"
+                    )
+        for trigger_name, trigger in self.triggers.items():
+            statements.append(f"CREATE TRIGGER IF NOT EXISTS {trigger_name} {trigger}")
+        return statements
 
-            if "index" not in table_info:
-                continue
+    def create(self):
+        """Create database and tables, along with any missing indexes.
 
-            index_cols = ", ".join(table_info["index"])
-            index_query = (
-                f"CREATE INDEX {table_name}_run_id ON {table_name}({index_cols});"
-            )
+        Safe to run against an existing database. Everything is created by one
+        script in a single transaction.
+        """
+        statements = self.schema_statements()
+        script = "BEGIN;\n" + ";\n".join(statements) + ";\nCOMMIT;"
+        with self._write_lock:
+            conn = self.db
             try:
-                self.execute(index_query)
-            except sqlite3.OperationalError:
-                pass
+                conn.executescript(script)
+                return
+            except sqlite3.IntegrityError:
+                conn.rollback()
+
+            # a unique index can't be built over existing duplicate rows, so create
+            # everything else one statement at a time
+            for statement in statements:
+                try:
+                    self.execute(statement)
+                except sqlite3.IntegrityError:
+                    # without the unique index duplicates are no longer detected
+                    logger.warning(
+                        f"Could not run '{statement}' as duplicate rows exist, so "
+                        "uniqueness is not enforced until they are removed"
+                    )
 
     def clean(self, check=False):
         """Clean a database ready to start again."""
@@ -147,7 +453,13 @@ class RunningDatabase(object):
 
         for table_name in self.tables:
             self.execute(f"DROP TABLE IF EXISTS {table_name}")
-        os.remove(f"{self.name}.db")
+        self.close()
+        self._created_paths.discard(os.path.abspath(f"{self.name}.db"))
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(f"{self.name}.db{suffix}")
+            except FileNotFoundError:
+                pass
 
     def exists(self) -> bool:
         """Whether the tables exist yet."""
@@ -165,41 +477,131 @@ class RunningDatabase(object):
 
     @staticmethod
     def get_duration_minutes(duration: str) -> float:
-        """Convert string duration into duration in minutes."""
-        hours = int(duration[:2])
-        minutes = int(duration[3:5])
-        seconds = int(duration[6:8])
-        ms = int(duration[9:])
-        return hours * 60 + minutes + seconds / 60 + ms / 6000
+        """Convert string duration into duration in minutes.
+
+        Durations come from a time input, so are 'HH:MM' optionally followed by
+        seconds with any number of fractional digits, e.g. 'HH:MM:SS.sss'.
+        """
+        hours, minutes, *seconds = duration.split(":")
+        total_minutes = int(hours) * 60 + int(minutes)
+        if seconds:
+            return total_minutes + float(seconds[0]) / 60
+        return float(total_minutes)
+
+    @staticmethod
+    def get_linestring_bounds(linestring: str) -> Tuple[float, float, float, float]:
+        """Bounding box of a 'LINESTRING(lat_1 lng_1, ...)'.
+
+        Returned as (min lat, min lng, max lat, max lng).
+        """
+        coords = linestring[linestring.index("(") + 1 : linestring.rindex(")")]
+        lats = []
+        lngs = []
+        for point in coords.split(","):
+            lat, lng = point.split()
+            lats.append(float(lat))
+            lngs.append(float(lng))
+        return min(lats), min(lngs), max(lats), max(lngs)
 
     def get_user(self, username: str) -> Optional[CurrentUser]:
-        """Return user details if they exist."""
-        query = "SELECT * FROM users WHERE username = ?"
-        try:
-            result = self.execute(
-                query, query_params=(username,), expect_data=True, one=True
-            )
-            username, hashed_password = result
-            run_area = self.get_active_area_for_user(username)
-            active_area_name = None if run_area is None else run_area.area_name
-            polygon = None if run_area is None else run_area.polygon
-            return CurrentUser(
+        """Return user details if they exist, along with their active area.
+
+        Users are cached for a few seconds, as they are needed on every request.
+        The user returned is shared, so must not be modified.
+        """
+        user = self._user_cache.get(username)
+        if user is not None:
+            return user
+
+        query = """
+            SELECT
+                u.username,
+                u.hashed_password,
+                ra.area_name,
+                ra.polygon
+            FROM users u
+            LEFT JOIN run_areas ra
+                ON ra.username = u.username
+                AND ra.active = 1
+            WHERE u.username = ?
+        """
+        result = self.execute(
+            query, query_params=(username,), expect_data=True, one=True
+        )
+        if result is None:
+            return None
+        username, hashed_password, active_area_name, polygon = result
+        user = CurrentUser(
+            username=username,
+            hashed_password=hashed_password,
+            active_area_name=active_area_name,
+            polygon=polygon,
+        )
+        self._user_cache.set(username, user)
+        return user
+
+    def forget_user(self, username: str) -> None:
+        """Drop a user from the cache, after they or their active area change."""
+        self._user_cache.pop(username)
+
+    def get_user_context(
+        self, username: str, artifacts_exist: bool = False
+    ) -> Optional[UserContext]:
+        """Return user details and their run areas if the user exists.
+
+        Loads what would otherwise take `get_user` and `get_areas_for_user` in one
+        query. `artifacts_exist` has the same meaning as for `get_areas_for_user`.
+        """
+        query = """
+            SELECT
+                u.username,
+                u.hashed_password,
+                ra.area_name,
+                ra.polygon,
+                ra.active,
+                ra.graph IS NOT NULL AND ra.geometry IS NOT NULL AS has_artifacts
+            FROM users u
+            LEFT JOIN run_areas ra
+                ON ra.username = u.username
+            WHERE u.username = ?
+        """
+        results = self.execute(query, query_params=(username,), expect_data=True)
+        if not results:
+            return None
+
+        active_area = None
+        run_areas = []
+        for _, _, area_name, polygon, active, has_artifacts in results:
+            if area_name is None:
+                # the user has no run areas
+                break
+            run_area = RunArea(
                 username=username,
-                hashed_password=hashed_password,
-                active_area_name=active_area_name,
+                area_name=area_name,
                 polygon=polygon,
+                active=active,
             )
-        except TypeError:
-            return None
+            if run_area.active:
+                active_area = run_area
+            if has_artifacts or not artifacts_exist:
+                run_areas.append(run_area)
+
+        user = CurrentUser(
+            username=username,
+            hashed_password=results[0]["hashed_password"],
+            active_area_name=None if active_area is None else active_area.area_name,
+            polygon=None if active_area is None else active_area.polygon,
+        )
+        return UserContext(user=user, run_areas=run_areas)
 
     def insert_user(self, username: str, hashed_password: str) -> None:
         """Insert a user into the database."""
-        existing_user = self.get_user(username)
-        if existing_user is not None:
+        # the unique index on username makes this a no-op for existing users
+        query = "INSERT OR IGNORE INTO users VALUES (?, ?)"
+        inserted = self.execute(query, query_params=(username, hashed_password))
+        if not inserted:
             raise exceptions.UsernameExistsError(username)
-
-        query = "INSERT INTO users VALUES (?, ?)"
-        self.execute(query, query_params=(username, hashed_password))
+        self.forget_user(username)
 
     def set_active_area_for_user(
         self, username: str, area_name: str
@@ -221,6 +623,7 @@ class RunningDatabase(object):
             ),
             expect_data=False,
         )
+        self.forget_user(username)
         return self.get_active_area_for_user(username)
 
     def get_active_area_for_user(self, username: str) -> Optional[RunArea]:
@@ -288,18 +691,23 @@ class RunningDatabase(object):
 
     def insert_run_area(self, run_area: RunArea) -> None:
         """Insert a run area into the database."""
-        existing_areas = self.get_areas_for_user(run_area.username)
-        if any(run_area.area_name == area.area_name for area in existing_areas):
-            raise exceptions.RunAreaExistsError(run_area)
-
-        query = "INSERT INTO run_areas (username, area_name, polygon, active) VALUES (?, ?, ?, ?)"
+        # the unique index on (username, area_name) makes this a no-op for
+        # existing areas
+        query = """
+            INSERT OR IGNORE INTO run_areas (username, area_name, polygon, active)
+            VALUES (?, ?, ?, ?)
+        """
         query_params = (
             run_area.username,
             run_area.area_name,
             run_area.polygon,
             int(run_area.active),
         )
-        self.execute(query, query_params=query_params)
+        inserted = self.execute(query, query_params=query_params)
+        if not inserted:
+            raise exceptions.RunAreaExistsError(run_area)
+        if run_area.active:
+            self.forget_user(run_area.username)
 
     def insert_run_area_geometry(
         self, username: str, area_name: str, geometry: Dict
@@ -311,25 +719,37 @@ class RunningDatabase(object):
             WHERE username = ?
                 AND area_name = ?
         """
-        # json.dumps?
-        query_params = (json.dumps(geometry), username, area_name)
+        query_params = (compress_json(geometry), username, area_name)
         self.execute(query, query_params=query_params)
 
-    def insert_run_area_graph(self, username: str, area_name: str, graph: Dict) -> None:
-        """Insert a run area's graph into the database."""
+    def insert_run_area_graph(
+        self, username: str, area_name: str, graph: Union[nx.Graph, Dict]
+    ) -> None:
+        """Insert a run area's graph into the database.
+
+        The graph can be given as node-link data, and is stored pickled.
+        """
+        if isinstance(graph, dict):
+            graph = json_graph.node_link_graph(graph)
         query = """
             UPDATE run_areas
             SET graph = ?
             WHERE username = ?
                 AND area_name = ?
         """
-        # json.dumps?
-        query_params = (json.dumps(graph), username, area_name)
+        raw_graph = compress(pickle.dumps(graph, protocol=PICKLE_PROTOCOL))
+        query_params = (raw_graph, username, area_name)
         self.execute(query, query_params=query_params)
+        self.forget_run_area_graph(username, area_name)
 
-    @lru_cache(maxsize=1)
-    def get_run_area_graph(self, username: str, area_name: str) -> Optional[Dict]:
-        """Get a run area's graph."""
+    def forget_run_area_graph(self, username: str, area_name: str) -> None:
+        """Drop a run area's graph from the cache, after it changes."""
+        self._graph_cache.pop((username, area_name))
+
+    def _fetch_raw_graph(
+        self, username: str, area_name: str
+    ) -> Optional[Union[bytes, str]]:
+        """Get a run area's graph as stored."""
         query = """
             SELECT graph
             FROM run_areas
@@ -337,14 +757,29 @@ class RunningDatabase(object):
                 AND area_name = ?
         """
         query_params = (username, area_name)
-        try:
-            raw_graph, *_ = self.execute(
-                query, query_params=query_params, expect_data=True, one=True
-            )
-            graph_data = json.loads(raw_graph)
-            return json_graph.node_link_graph(graph_data)
-        except TypeError:
+        result = self.execute(
+            query, query_params=query_params, expect_data=True, one=True
+        )
+        return None if result is None else result[0]
+
+    def get_run_area_graph(self, username: str, area_name: str) -> Optional[nx.Graph]:
+        """Get a run area's graph.
+
+        Parsed graphs are cached and shared between calls, so callers must not
+        modify the graph returned. Graphs are held by area for a while, so that
+        repeat calls needn't even fetch the stored graph.
+        """
+        key = (username, area_name)
+        graph = self._graph_cache.get(key)
+        if graph is not None:
+            return graph
+
+        raw_graph = self._fetch_raw_graph(username, area_name)
+        if raw_graph is None:
             return None
+        graph = _parse_graph(raw_graph)
+        self._graph_cache.set(key, graph)
+        return graph
 
     def get_run_area_geometry(self, username: str, area_name: str) -> Optional[Dict]:
         """Get a run area's geometry."""
@@ -359,9 +794,11 @@ class RunningDatabase(object):
             geometry, *_ = self.execute(
                 query, query_params=query_params, expect_data=True, one=True
             )
-            return json.loads(geometry)
         except TypeError:
             return None
+        if geometry is None:
+            return None
+        return decompress_json(geometry)
 
     def store_run(self, run_area: RunArea, run: LoggedRun) -> dict:
         """Store a run.
@@ -372,18 +809,13 @@ class RunningDatabase(object):
             Including status of whether insertion of new segments was successful.
             Failure is due to an existing run on the date if `allow_multiple` is False.
         """
-        if not run.allow_multiple and self.exists_run_on_date(run_area, run.date):
-            reason = f"Run already exists for {run.date}, and `allow_multiple`=False: "
-            reason += "new segments will not be added."
-            return {"status_code": 400, "reason": reason}
-
-        run_id = str(uuid.uuid4())
+        # stored as 16 raw bytes rather than the 36 character text form
+        run_id = uuid.uuid4().bytes
 
         logged_run_query = "INSERT INTO logged_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
-        try:
-            duration_minutes = self.get_duration_minutes(run.duration)
-        except TypeError:
-            duration_minutes = None
+        duration_minutes = (
+            None if run.duration is None else self.get_duration_minutes(run.duration)
+        )
         run_query_params = (
             run_id,
             run_area.username,
@@ -394,16 +826,28 @@ class RunningDatabase(object):
             run.comments,
             run.linestring,
         )
-        self.execute(logged_run_query, query_params=run_query_params)
-
-        traversal_query_params = [
+        # streamed into executemany rather than built up as a list first
+        traversal_query_params = (
             (run_id, segment_id, count)
             for segment_id, count in run.segment_traversals.items()
-        ]
-        segment_traversals_query = "INSERT INTO segment_traversals VALUES (?, ?, ?)"
-        self.execute(
-            segment_traversals_query, query_params=traversal_query_params, many=True
         )
+        segment_traversals_query = "INSERT INTO segment_traversals VALUES (?, ?, ?)"
+        # the check shares the transaction, so a concurrent upload for the same
+        # date can't be stored in between
+        with self.transaction():
+            if not run.allow_multiple and self._has_run_on_date(run_area, run.date):
+                reason = f"Run already exists for {run.date}, "
+                reason += "and `allow_multiple`=False: new segments will not be added."
+                return {"status_code": 400, "reason": reason}
+
+            self.execute(logged_run_query, query_params=run_query_params)
+            self.execute(
+                segment_traversals_query, query_params=traversal_query_params, many=True
+            )
+            if run.linestring is not None:
+                bounds = self.get_linestring_bounds(run.linestring)
+                bounds_query = "INSERT INTO run_bounds VALUES (?, ?, ?, ?, ?)"
+                self.execute(bounds_query, query_params=(run_id, *bounds))
 
         return {"status_code": 200}
 
@@ -424,16 +868,20 @@ class RunningDatabase(object):
         if not segment_collection.segment_ids:
             return
 
-        placeholders = ", ".join(["?" for _ in segment_collection.segment_ids])
-        delete_query = f"""
+        # ids are bound as one JSON array so the statement is the same for any
+        # number of segments
+        delete_query = """
             DELETE FROM ignored_segments
             WHERE username = ?
                 AND area_name = ?
-                AND segment_id IN ({placeholders})
+                AND segment_id IN (SELECT value FROM json_each(?))
         """
-        query_params = [segment_collection.username, segment_collection.area_name]
-        query_params += segment_collection.segment_ids
-        self.execute(delete_query, query_params=tuple(query_params))
+        query_params = (
+            segment_collection.username,
+            segment_collection.area_name,
+            orjson.dumps(segment_collection.segment_ids).decode("utf-8"),
+        )
+        self.execute(delete_query, query_params=query_params)
 
     def add_to_ignored_segments(self, segment_collection: SegmentCollection):
         """Add specified segments to ignore set."""
@@ -444,58 +892,62 @@ class RunningDatabase(object):
             (segment_collection.username, segment_collection.area_name, segment_id)
             for segment_id in segment_collection.segment_ids
         ]
-        insert_query = "INSERT INTO ignored_segments VALUES (?, ?, ?)"
+        insert_query = "INSERT OR IGNORE INTO ignored_segments VALUES (?, ?, ?)"
         self.execute(insert_query, query_params=query_params, many=True)
 
     def update_ignored_segments(self, segment_collection: SegmentCollection):
-        """Update the table of segments which should be ignored."""
+        """Update the table of segments which should be ignored.
+
+        Additions and removals are made in a single transaction.
+        """
         run_area = BaseRunArea(
             username=segment_collection.username,
             area_name=segment_collection.area_name
         )
-        currently_ignored_segment_ids = set(self.ignored_segment_ids(run_area))
-
-        new_ignored_segment_ids = [
-            segment_id
-            for segment_id in segment_collection.segment_ids
-            if segment_id not in currently_ignored_segment_ids
-        ]
-        self.add_to_ignored_segments(
-            SegmentCollection(
-                username=segment_collection.username,
-                area_name=segment_collection.area_name,
-                segment_ids=new_ignored_segment_ids,
+        with self.transaction():
+            currently_ignored_segment_ids = set(self.ignored_segment_ids(run_area))
+
+            new_ignored_segment_ids = [
+                segment_id
+                for segment_id in segment_collection.segment_ids
+                if segment_id not in currently_ignored_segment_ids
+            ]
+            self.add_to_ignored_segments(
+                SegmentCollection(
+                    username=segment_collection.username,
+                    area_name=segment_collection.area_name,
+                    segment_ids=new_ignored_segment_ids,
+                )
             )
-        )
 
-        segment_ids_to_no_longer_ignore = [
-            segment_id
-            for segment_id in segment_collection.segment_ids
-            if segment_id in currently_ignored_segment_ids
-        ]
-        self.remove_from_ignored_segments(
-            SegmentCollection(
-                username=segment_collection.username,
-                area_name=segment_collection.area_name,
-                segment_ids=segment_ids_to_no_longer_ignore,
+            segment_ids_to_no_longer_ignore = [
+                segment_id
+                for segment_id in segment_collection.segment_ids
+                if segment_id in currently_ignored_segment_ids
+            ]
+            self.remove_from_ignored_segments(
+                SegmentCollection(
+                    username=segment_collection.username,
+                    area_name=segment_collection.area_name,
+                    segment_ids=segment_ids_to_no_longer_ignore,
+                )
             )
-        )
 
     def make_date_clause(
         self, start_date: Optional[str] = None, end_date: Optional[str] = None
-    ) -> str:
-        """Create clause to filter runs between start and end dates."""
-        if start_date is None and end_date is None:
-            return {"clause": "WHERE 1 = 1", "query_params": []}
-        elif start_date is None:
-            return {"clause": "WHERE date <= ?", "query_params": [end_date]}
-        elif end_date is None:
-            return {"clause": "WHERE date >= ?", "query_params": [start_date]}
-        else:
-            return {
-                "clause": "WHERE date BETWEEN ? AND ?",
-                "query_params": [start_date, end_date],
-            }
+    ) -> Dict:
+        """Create clause to filter runs between start and end dates.
+
+        The clause is the same whichever dates are given, with open ends bound as
+        NULL, so each query's SQL and therefore its cached plan is shared.
+        """
+        return {
+            "clause": (
+                "WHERE date BETWEEN COALESCE(?, '0000-01-01') "
+                "AND COALESCE(?, '9999-12-31')"
+            ),
+            "query_params": [start_date, end_date],
+        }
 
     def number_runs_in_date_range(
         self,
@@ -529,14 +981,19 @@ class RunningDatabase(object):
         run_area: RunArea,
         start_date: Optional[str] = None,
         end_date: Optional[str] = None,
-    ) -> List[Dict[str, str]]:
-        """Get all runs in time range."""
+        stream: bool = False,
+    ) -> Union[List[sqlite3.Row], Iterator[sqlite3.Row]]:
+        """Get all runs in time range.
+
+        Rows have `date`, `segment_id` and `traversals` columns. If `stream`, they
+        are yielded lazily instead of being fetched all at once.
+        """
         date_clause = self.make_date_clause(start_date=start_date, end_date=end_date)
         query = f"""
             SELECT
-                 lr.date,
-                 st.segment_id,
-                 st.traversals
+                 lr.date AS date,
+                 st.segment_id AS segment_id,
+                 st.traversals AS traversals
             FROM segment_traversals st
             INNER JOIN (
                 SELECT 
@@ -554,15 +1011,11 @@ class RunningDatabase(object):
             run_area.username,
             run_area.area_name,
         ]
-        results = self.execute(
-            query, query_params=tuple(query_params), expect_data=True
-        )
-        return [
-            {"date": date, "segment_id": segment_id, "traversals": traversals}
-            for date, segment_id, traversals in results
-        ]
+        if stream:
+            return self.iterate(query, query_params=tuple(query_params))
+        return self.execute(query, query_params=tuple(query_params), expect_data=True)
 
-    def all_runs(self, run_area: RunArea) -> List[Dict[str, str]]:
+    def all_runs(self, run_area: RunArea) -> List[sqlite3.Row]:
         """Get all stored runs."""
         return self.runs_in_date_range(run_area)
 
@@ -571,13 +1024,18 @@ class RunningDatabase(object):
         run_area: RunArea,
         start_date: Optional[str] = None,
         end_date: Optional[str] = None,
-    ) -> List[Dict[str, str]]:
-        """Find the first date in the date range on which a segment was coverd."""
+        stream: bool = False,
+    ) -> Union[List[sqlite3.Row], Iterator[sqlite3.Row]]:
+        """Find the first date in the date range on which a segment was coverd.
+
+        Rows have `date` and `segment_id` columns. If `stream`, they are yielded
+        lazily instead of being fetched all at once.
+        """
         date_clause = self.make_date_clause(start_date=start_date, end_date=end_date)
         query = f"""
             SELECT
-                 MIN(lr.date),
-                 st.segment_id
+                 MIN(lr.date) AS date,
+                 st.segment_id AS segment_id
             FROM segment_traversals st
             INNER JOIN (
                 SELECT
@@ -596,62 +1054,99 @@ class RunningDatabase(object):
             run_area.username,
             run_area.area_name,
         ]
-        results = self.execute(
-            query, query_params=tuple(query_params), expect_data=True
-        )
-        return [
-            {"date": date, "segment_id": segment_id} for date, segment_id in results
-        ]
+        if stream:
+            return self.iterate(query, query_params=tuple(query_params))
+        return self.execute(query, query_params=tuple(query_params), expect_data=True)
 
-    def run_on_date(self, run_area: RunArea, date: str) -> List[Dict[str, str]]:
+    def run_on_date(self, run_area: RunArea, date: str) -> List[sqlite3.Row]:
         """Get run on a specific date."""
         return self.runs_in_date_range(run_area, start_date=date, end_date=date)
 
     def delete_runs_on_date(self, run_area: RunArea, date: str):
-        """Delete runs on specified date."""
-        run_id_query = """
+        """Delete runs on specified date.
+
+        Traversals and bounds are deleted via a subquery on the runs being removed,
+        so no ids need to be fetched first.
+        """
+        run_ids_query = """
             SELECT id
             FROM logged_runs
             WHERE username = ?
                 AND area_name = ?
                 AND date = ?
         """
-        query_params = (run_area.username, run_area.area_name, date)
-        results = self.execute(run_id_query, query_params=query_params)
-        run_ids = tuple([id for id, *_ in results])
-
-        placeholders = ", ".join(["?" for _ in run_ids])
-        logged_run_query = f"DELETE FROM logged_runs WHERE id IN ({placeholders})"
-        self.execute(logged_run_query, query_params=run_ids)
-
         traversals_query = (
-            f"DELETE FROM segment_traversals WHERE run_id IN ({placeholders})"
+            f"DELETE FROM segment_traversals WHERE run_id IN ({run_ids_query})"
         )
-        self.execute(traversals_query, query_params=run_ids)
+        bounds_query = f"DELETE FROM run_bounds WHERE run_id IN ({run_ids_query})"
+        logged_run_query = """
+            DELETE FROM logged_runs
+            WHERE username = ?
+                AND area_name = ?
+                AND date = ?
+        """
+        query_params = (run_area.username, run_area.area_name, date)
+        with self.transaction():
+            self.execute(traversals_query, query_params=query_params)
+            self.execute(bounds_query, query_params=query_params)
+            self.execute(logged_run_query, query_params=query_params)
 
     def delete_run_by_id(self, id: str):
-        """Delete run with specific id."""
-        logged_run_query = "DELETE FROM logged_runs WHERE id = ?"
-        self.execute(logged_run_query, query_params=(id,))
+        """Delete run with specific id.
 
-        traversals_query = "DELETE FROM segment_traversals WHERE run_id = ?"
-        self.execute(traversals_query, query_params=(id,))
+        Ids are stored as bytes, or as text for runs stored by earlier versions,
+        so both forms are matched.
+        """
+        try:
+            run_id = uuid.UUID(id)
+            query_params = (run_id.bytes, str(run_id))
+        except ValueError:
+            query_params = (id, id)
+
+        with self.transaction():
+            logged_run_query = "DELETE FROM logged_runs WHERE id IN (?, ?)"
+            self.execute(logged_run_query, query_params=query_params)
+
+            traversals_query = "DELETE FROM segment_traversals WHERE run_id IN (?, ?)"
+            self.execute(traversals_query, query_params=query_params)
+
+            bounds_query = "DELETE FROM run_bounds WHERE run_id IN (?, ?)"
+            self.execute(bounds_query, query_params=query_params)
+
+    def _has_run_on_date(self, run_area: BaseRunArea, date: str) -> bool:
+        """Check for a run on a date, stopping at the first one found."""
+        query = """
+            SELECT 1
+            FROM logged_runs
+            WHERE username = ?
+                AND area_name = ?
+                AND date = ?
+            LIMIT 1
+        """
+        query_params = (run_area.username, run_area.area_name, date)
+        result = self.execute(
+            query, query_params=query_params, expect_data=True, one=True
+        )
+        return result is not None
 
     def exists_run_on_date(self, run_area: RunArea, date: str) -> bool:
         """Indicates if a run for a given date is already stored."""
-        return bool(self.run_on_date(run_area, date))
+        return self._has_run_on_date(run_area, date)
 
     def number_of_traversals_in_date_range(
         self,
         run_area: RunArea,
         start_date: Optional[str] = None,
         end_date: Optional[str] = None,
-    ) -> List[Dict[str, Union[str, int]]]:
-        """Count the number of times each segment has been run in date range."""
+    ) -> List[sqlite3.Row]:
+        """Count the number of times each segment has been run in date range.
+
+        Rows have `segment_id` and `num_traversals` columns.
+        """
         date_clause = self.make_date_clause(start_date=start_date, end_date=end_date)
         query = f"""
             SELECT
-                 st.segment_id,
+                 st.segment_id AS segment_id,
                  SUM(st.traversals) AS num_traversals
             FROM segment_traversals st
             INNER JOIN (
@@ -668,28 +1163,78 @@ class RunningDatabase(object):
             run_area.username,
             run_area.area_name,
         ]
-        results = self.execute(
-            query, query_params=tuple(query_params), expect_data=True
-        )
-        return [
-            {"segment_id": segment_id, "num_traversals": num_traversals}
-            for segment_id, num_traversals in results
-        ]
+        return self.execute(query, query_params=tuple(query_params), expect_data=True)
 
-    def total_number_of_traversals(
-        self, run_area: RunArea
-    ) -> List[Dict[str, Union[str, int]]]:
+    def total_number_of_traversals(self, run_area: RunArea) -> List[sqlite3.Row]:
         """Count the number of times each segment has been run in total."""
         return self.number_of_traversals_in_date_range(run_area)
 
+    def segment_stats_in_date_range(
+        self,
+        run_area: RunArea,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+    ) -> List[sqlite3.Row]:
+        """First date covered and number of traversals for each segment in date range.
+
+        Combines `first_seen` and `number_of_traversals_in_date_range` in a single
+        pass, for callers that need both. Rows have `segment_id`, `first_seen` and
+        `num_traversals` columns, ordered by `first_seen`.
+        """
+        date_clause = self.make_date_clause(start_date=start_date, end_date=end_date)
+        query = f"""
+            SELECT
+                 st.segment_id AS segment_id,
+                 MIN(lr.date) AS first_seen,
+                 SUM(st.traversals) AS num_traversals
+            FROM segment_traversals st
+            INNER JOIN (
+                SELECT
+                    id,
+                    date
+                FROM logged_runs
+                {date_clause['clause']}
+                    AND username = ?
+                    AND area_name = ?
+            ) lr
+                ON st.run_id == lr.id
+            GROUP BY st.segment_id
+            ORDER BY MIN(lr.date)
+        """
+        query_params = date_clause["query_params"] + [
+            run_area.username,
+            run_area.area_name,
+        ]
+        return self.execute(query, query_params=tuple(query_params), expect_data=True)
+
     def uploaded_runs_in_date_range(
         self,
         run_area: RunArea,
         start_date: Optional[str] = None,
         end_date: Optional[str] = None,
-    ) -> List[Dict[str, Union[str, int]]]:
-        """Retrieve all run geometries in date range."""
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        stream: bool = False,
+    ) -> Union[List[sqlite3.Row], Iterator[sqlite3.Row]]:
+        """Retrieve all run geometries in date range.
+
+        Rows have `date` and `linestring` columns. If a `bbox` of (min lat, min lng,
+        max lat, max lng) is given, only runs which could intersect it are included,
+        without their linestrings needing to be read. If `stream`, rows are yielded
+        lazily instead of being fetched all at once.
+        """
         date_clause = self.make_date_clause(start_date=start_date, end_date=end_date)
+        bbox_clause = ""
+        if bbox is not None:
+            # runs stored before bounds were recorded have none, so are kept
+            bbox_clause = """
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM run_bounds rb
+                    WHERE rb.run_id = logged_runs.id
+                        AND (rb.max_lat < ? OR rb.max_lng < ?
+                            OR rb.min_lat > ? OR rb.min_lng > ?)
+                )
+            """
         query = f"""
             SELECT
                 date,
@@ -699,18 +1244,18 @@ class RunningDatabase(object):
                 AND username = ?
                 AND area_name = ?
                 AND linestring IS NOT NULL
+                {bbox_clause}
             ORDER BY date ASC
         """
         query_params = date_clause["query_params"] + [
             run_area.username,
             run_area.area_name,
         ]
-        results = self.execute(
-            query, query_params=tuple(query_params), expect_data=True
-        )
-        return [
-            {"date": date, "linestring": linestring} for date, linestring in results
-        ]
+        if bbox is not None:
+            query_params += list(bbox)
+        if stream:
+            return self.iterate(query, query_params=tuple(query_params))
+        return self.execute(query, query_params=tuple(query_params), expect_data=True)
 
     def get_sub_run_area(self, sub_run_area: SubRunArea):
         """Get all information about a sub run area."""
@@ -775,18 +1320,18 @@ class RunningDatabase(object):
         if sub_run_area.polygon is None:
             raise exceptions.MissingPolygonError(sub_run_area)
 
-        existing_sub_run_area = self.get_sub_run_area(sub_run_area)
-        if existing_sub_run_area is not None:
-            raise exceptions.SubRunAreaExistsError(sub_run_area)
-
-        query = "INSERT INTO sub_run_areas VALUES (?, ?, ?, ?)"
+        # the unique index on (username, area_name, sub_area_name) makes this a
+        # no-op for existing sub run areas
+        query = "INSERT OR IGNORE INTO sub_run_areas VALUES (?, ?, ?, ?)"
         query_params = (
             sub_run_area.username,
             sub_run_area.area_name,
             sub_run_area.sub_area_name,
             sub_run_area.polygon,
         )
-        self.execute(query, query_params=query_params)
+        inserted = self.execute(query, query_params=query_params)
+        if not inserted:
+            raise exceptions.SubRunAreaExistsError(sub_run_area)
 
     def remove_sub_run_area(self, sub_run_area: SubRunArea) -> None:
         """Remove a sub run area from the database."""
@@ -806,48 +1351,40 @@ class RunningDatabase(object):
     def remove_run_area(self, run_area: RunArea) -> None:
         """Remove a run area from the database.
         
-        This requires data being removed from several tables.
+        This requires data being removed from several tables, which is done by a
+        trigger on run_areas within a single transaction.
         """
         run_area_query_params = (run_area.username, run_area.area_name)
 
-        # set a new active area if this area is active and more exist for this user
-        query = """
-            SELECT active
-            FROM run_areas
-            WHERE username = ?
-                AND area_name = ?
-        """
-        active = self.execute(query, query_params=run_area_query_params, expect_data=True, one=True)
-        
-        query = """
-            SELECT area_name 
-            FROM run_areas 
-            WHERE username = ?
-                AND area_name != ?
-        """
-        results = self.execute(query, query_params=run_area_query_params, expect_data=True, one=True)
-        run_area_names = [area_name for area_name, *_ in results]
-        
-        if active and run_area_names:
-            self.set_active_area_for_user(run_area.username, run_area_names[0])
-
-        # we need to get the relevant run ids to delete segment traversals
-        query = """
-            SELECT id
-            FROM ignored_segments
-            WHERE username = ?
-                AND area_name = ?
-        """
-        results = self.execute(query, query_params=run_area_query_params, expect_data=True)
-        run_ids = {run_id for run_id, *_ in results}
+        with self.transaction():
+            # set a new active area if this area is active and more exist for this user
+            query = """
+                SELECT active
+                FROM run_areas
+                WHERE username = ?
+                    AND area_name = ?
+            """
+            result = self.execute(
+                query, query_params=run_area_query_params, expect_data=True, one=True
+            )
+            active = result is not None and result["active"]
+
+            query = """
+                SELECT area_name 
+                FROM run_areas 
+                WHERE username = ?
+                    AND area_name != ?
+            """
+            results = self.execute(
+                query, query_params=run_area_query_params, expect_data=True
+            )
+            run_area_names = [area_name for area_name, *_ in results]
 
-        if run_ids:
-            placeholders = ", ".join(["?" for _ in run_ids])
-            query = f"DELETE FROM segment_traversals WHERE run_id IN ({placeholders})"
-            self.execute(query, query_params=tuple(run_ids))
+            if active and run_area_names:
+                self.set_active_area_for_user(run_area.username, run_area_names[0])
 
-        # remaining tables are easier
-        for table in ("run_areas", "sub_run_areas", "ignored_segments", "logged_runs"):
-            query = f"DELETE FROM {table} WHERE username = ? AND area_name = ?"
+            # the area's data in other tables is removed by a trigger
+            query = "DELETE FROM run_areas WHERE username = ? AND area_name = ?"
             self.execute(query, query_params=run_area_query_params)
- 
\ No newline at end of file
+        self.forget_run_area_graph(run_area.username, run_area.area_name)
+        self.forget_user(run_area.username)
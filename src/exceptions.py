@@ -1,4 +1,8 @@
-"""Exceptions."""
+"""Exceptions.
+
+Messages are only formatted when asked for, as these are often raised and
+caught without ever being displayed.
+"""
 
 
 class UsernameExistsError(ValueError):
@@ -6,8 +10,14 @@ class UsernameExistsError(ValueError):
 
     def __init__(self, username: str):
         self.username = username
-        self.message = f"username={username} already exists"
-        super().__init__(self.message)
+        super().__init__(username)
+
+    @property
+    def message(self) -> str:
+        return f"username={self.username} already exists"
+
+    def __str__(self) -> str:
+        return self.message
 
 
 class RunAreaExistsError(ValueError):
@@ -15,11 +25,17 @@ class RunAreaExistsError(ValueError):
 
     def __init__(self, run_area: "RunArea"):
         self.run_area = run_area
-        self.message = (
-            f"area_name={run_area.area_name} for "
-            f"username={run_area.username} already exists."
+        super().__init__(run_area)
+
+    @property
+    def message(self) -> str:
+        return (
+            f"area_name={self.run_area.area_name} for "
+            f"username={self.run_area.username} already exists."
         )
-        super().__init__(self.message)
+
+    def __str__(self) -> str:
+        return self.message
 
 
 class SubRunAreaExistsError(ValueError):
@@ -27,12 +43,18 @@ class SubRunAreaExistsError(ValueError):
 
     def __init__(self, sub_run_area: "SubRunArea"):
         self.sub_run_area = sub_run_area
-        self.message = (
-            f"sub_area_name={sub_run_area.sub_area_name} in "
-            f"run_area={sub_run_area.area_name} for"
-            f"username={sub_run_area.username} already exists."
+        super().__init__(sub_run_area)
+
+    @property
+    def message(self) -> str:
+        return (
+            f"sub_area_name={self.sub_run_area.sub_area_name} in "
+            f"run_area={self.sub_run_area.area_name} for "
+            f"username={self.sub_run_area.username} already exists."
         )
-        super().__init__(self.message)
+
+    def __str__(self) -> str:
+        return self.message
 
 
 class MissingPolygonError(ValueError):
@@ -40,10 +62,16 @@ class MissingPolygonError(ValueError):
 
     def __init__(self, sub_run_area: "SubRunArea"):
         self.sub_run_area = sub_run_area
-        self.message = (
-            f"sub_area_name={sub_run_area.sub_area_name} in "
-            f"run_area={sub_run_area.area_name} for"
-            f"username={sub_run_area.username} cannot be inserted as it "
+        super().__init__(sub_run_area)
+
+    @property
+    def message(self) -> str:
+        return (
+            f"sub_area_name={self.sub_run_area.sub_area_name} in "
+            f"run_area={self.sub_run_area.area_name} for "
+            f"username={self.sub_run_area.username} cannot be inserted as it "
             "does not have a polygon in WKT format."
         )
-        super().__init__(self.message)
+
+    def __str__(self) -> str:
+        return self.message
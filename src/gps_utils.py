@@ -2,39 +2,168 @@
 
 Current support is for .tcx files as used by MapMyRun.
 """
-from defusedxml import ElementTree
+from functools import lru_cache
+import io
+import itertools
+from typing import Callable, IO, Iterator, Tuple, Union
+
+from lxml import etree
+import numpy as np
+
+
+DEFAULT_PREFIX = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+
+# files can be given as their text, their bytes or a binary file object
+TCXSource = Union[str, bytes, IO[bytes]]
+
+
+# files are uploaded by users, so entities and DTDs are never loaded and nothing
+# is fetched over the network, which is what defusedxml used to guard against
+PARSER_OPTIONS = {
+    "resolve_entities": False,
+    "no_network": True,
+    "load_dtd": False,
+    "huge_tree": False,
+}
+
+
+# longest excerpt of a file kept on errors, so large uploads aren't kept alive
+RAW_XML_LIMIT = 4096
+# bytes read for the excerpt, enough for the limit of characters at 4 bytes each
+RAW_XML_READ_SIZE = 4 * RAW_XML_LIMIT + 1
 
 
 class XMLParsingError(Exception):
-    """Error when parsing an XML file."""
+    """Error when parsing an XML file.
+
+    Only the start of the file is kept in `raw_xml`, which is always text so it
+    can be returned in a JSON response.
+    """
 
     def __init__(self, message: str, raw_xml: str):
         self.message = message
+        if len(raw_xml) > RAW_XML_LIMIT:
+            raw_xml = raw_xml[:RAW_XML_LIMIT] + "..."
         self.raw_xml = raw_xml
+        # replaces the args the exception was created with, which hold the file
+        super().__init__(message)
 
 
-def parse_tcx_file(
-    raw_xml: str,
-    prefix: str = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}",
-) -> str:
-    """Parse an uploaded .tcx file."""
-    try:
-        parsed_xml = ElementTree.fromstring(raw_xml)
-    except:
-        raise XMLParsingError("Could not parse XML file", raw_xml)
+def read_source(source: TCXSource) -> str:
+    """Get the start of a file as text for reporting errors.
+
+    Bytes which aren't valid UTF-8, including a character cut off at the end of
+    what is read, are replaced rather than raising.
+    """
+    if isinstance(source, str):
+        return source
+    if isinstance(source, bytes):
+        raw_xml = source[:RAW_XML_READ_SIZE]
+    else:
+        source.seek(0)
+        raw_xml = source.read(RAW_XML_READ_SIZE)
+    # more characters than the limit, so the error can tell it was truncated
+    return raw_xml.decode("utf-8", errors="replace")
+
+
+def open_source(source: TCXSource) -> IO[bytes]:
+    """Get a binary file object to stream a file from."""
+    if isinstance(source, str):
+        return io.BytesIO(source.encode("utf-8"))
+    elif isinstance(source, bytes):
+        return io.BytesIO(source)
+    return source
+
+
+@lru_cache(maxsize=8)
+def make_coordinate_iterator(
+    prefix: str,
+) -> Callable[[TCXSource], Iterator[Tuple[str, str]]]:
+    """Make a function streaming co-ordinates from .tcx files with a namespace prefix.
+
+    Tag names are built once and closed over, rather than looked up per file.
+    """
+    trackpoint_tag_name = f"{prefix}Trackpoint"
+    position_tag_name = f"{prefix}Position"
+
+    def iter_coordinates(source: TCXSource) -> Iterator[Tuple[str, str]]:
+        trackpoints = etree.iterparse(
+            open_source(source),
+            events=("end",),
+            tag=trackpoint_tag_name,
+            **PARSER_OPTIONS,
+        )
 
-    points = []
-    for position_tag in parsed_xml.iter(f"{prefix}Trackpoint"):
         try:
-            lat_tag, lng_tag = list(position_tag.find(f"{prefix}Position"))
-            lat = float(lat_tag.text)
-            lng = float(lng_tag.text)
-            points.append((lat, lng))
-        except TypeError:
-            pass
-
-    if not points:
-        raise XMLParsingError("No co-ordinates found in XML file", raw_xml)
-
-    formatted_points = ",".join([f"{lat} {lng}" for lat, lng in points])
-    return f"LINESTRING({formatted_points})"
+            for _, trackpoint_tag in trackpoints:
+                # trackpoints recorded while paused have no position, otherwise the
+                # schema has latitude then longitude as its only children
+                position_tag = trackpoint_tag.find(position_tag_name)
+                if position_tag is not None and len(position_tag) == 2:
+                    lat, lng = position_tag[0].text, position_tag[1].text
+                    if lat is not None and lng is not None:
+                        yield lat.strip(), lng.strip()
+
+                # free this trackpoint and any earlier siblings already processed
+                trackpoint_tag.clear()
+                while trackpoint_tag.getprevious() is not None:
+                    del trackpoint_tag.getparent()[0]
+        except etree.XMLSyntaxError as e:
+            line, column = e.position
+            raise XMLParsingError(
+                f"Could not parse XML file, error at line {line} column {column}",
+                read_source(source),
+            ) from e
+
+    return iter_coordinates
+
+
+# almost every file uses the default namespace, so its iterator is made up front
+_iter_default_coordinates = make_coordinate_iterator(DEFAULT_PREFIX)
+
+
+def iter_tcx_coordinates(
+    source: TCXSource, prefix: str = DEFAULT_PREFIX
+) -> Iterator[Tuple[str, str]]:
+    """Stream the latitude and longitude text of each trackpoint in a .tcx file.
+
+    Trackpoints are cleared once read, so the whole document is never held in
+    memory as a tree, and file objects are never read in full.
+    """
+    if prefix == DEFAULT_PREFIX:
+        return _iter_default_coordinates(source)
+    return make_coordinate_iterator(prefix)(source)
+
+
+def parse_tcx_file(source: TCXSource, prefix: str = DEFAULT_PREFIX) -> str:
+    """Parse an uploaded .tcx file into a WKT linestring.
+
+    Co-ordinates are written from their parsed values rather than the file's text,
+    which can use forms such as "+51.50" or ".5" that WKT validation rejects.
+    """
+    points = parse_tcx_points(source, prefix)
+    return (
+        "LINESTRING("
+        + ",".join(f"{lat!r} {lng!r}" for lat, lng in points.tolist())
+        + ")"
+    )
+
+
+def parse_tcx_points(source: TCXSource, prefix: str = DEFAULT_PREFIX) -> np.ndarray:
+    """Parse an uploaded .tcx file into an (N, 2) array of latitudes and longitudes.
+
+    For numeric consumers, which would otherwise have to parse the WKT again.
+    """
+    coordinates = itertools.chain.from_iterable(iter_tcx_coordinates(source, prefix))
+    try:
+        points = np.fromiter(coordinates, dtype=np.float64).reshape(-1, 2)
+    except ValueError as e:
+        raise XMLParsingError(
+            f"Invalid co-ordinate in XML file, {e}", read_source(source)
+        ) from e
+    # nan and inf parse as floats but are not positions
+    if not np.isfinite(points).all():
+        raise XMLParsingError("Invalid co-ordinate in XML file", read_source(source))
+    if not len(points):
+        raise XMLParsingError("No co-ordinates found in XML file", read_source(source))
+    return points
@@ -1,13 +1,19 @@
 """Main entrypoint to the app.
 """
-from datetime import timedelta
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
 from functools import lru_cache
+import itertools
 import json
 import logging
 from logging.config import dictConfig
+import multiprocessing
+from operator import itemgetter
 import os
 from pathlib import Path
-from typing import Dict, List, Optional
+import sqlite3
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from fastapi import (
     BackgroundTasks,
@@ -21,13 +27,24 @@ from fastapi import (
     status,
     UploadFile,
 )
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from jose import JWTError, jwt
-from networkx.algorithms import shortest_path
-import pandas as pd
+import jwt
+from networkx import is_frozen, MultiDiGraph, NetworkXNoPath, restricted_view
+from networkx.readwrite import json_graph
+import numpy as np
+import orjson
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from shapely.geometry import Polygon
 import uvicorn
 
@@ -40,11 +57,20 @@ import models
 from osm import preprocess_running_network
 
 
+APP_MODE = os.environ.get("RUNNING_APP_MODE", "DEV").upper()
 UPLOAD_EXTENSIONS = {".tcx"}
+GZIP_MINIMUM_SIZE = 1024
+STREAM_BATCH_SIZE = 1000
+PREPROCESSING_WORKERS = int(os.environ.get("RUNNING_APP_PREPROCESSING_WORKERS", 1))
+SEGMENT_EDGES_KEY = "segment_edges"
+EDGE_LENGTHS_KEY = "edge_lengths"
+ROUTING_MATRIX_KEY = "routing_matrix"
 
 dictConfig(logging_config)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+# run, traversal and geometry responses can be megabytes of repetitive JSON
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
@@ -56,64 +82,249 @@ async def favicon():
     return FileResponse("static/images/favicon.ico")
 
 
+def rows_to_dicts(rows: List[sqlite3.Row]) -> List[Dict]:
+    """Convert database rows to dicts, which orjson can serialise directly."""
+    return [dict(row) for row in rows]
+
+
+def json_chunks(
+    items: Iterable, collect: Callable, brackets: bytes = b"[]"
+) -> Iterator[bytes]:
+    """Serialise items into a JSON array, or object, a batch at a time.
+
+    Each batch is collected into a list, or dict, and serialised with its own
+    brackets stripped so that the batches join into one container.
+    """
+    opening, closing = brackets[:1], brackets[1:]
+    yield opening
+    items = iter(items)
+    separator = b""
+    while True:
+        batch = list(itertools.islice(items, STREAM_BATCH_SIZE))
+        if not batch:
+            break
+        yield separator + orjson.dumps(collect(batch))[1:-1]
+        separator = b","
+    yield closing
+
+
+def stream_json_array(items: Iterable) -> StreamingResponse:
+    """Stream items as a JSON array without building the whole list first.
+
+    Items are sent in batches, as each chunk of a response is produced in the
+    threadpool.
+    """
+    return StreamingResponse(json_chunks(items, list), media_type="application/json")
+
+
+def stream_json_object(items: Iterable[Tuple[str, object]]) -> StreamingResponse:
+    """Stream (key, value) pairs as a JSON object, see `stream_json_array`."""
+    return StreamingResponse(
+        json_chunks(items, dict, brackets=b"{}"), media_type="application/json"
+    )
+
+
+def lat_lng_array(geometry: List[Dict[str, float]]) -> np.ndarray:
+    """(lat, lng) co-ordinates of a drawn geometry as an (N, 2) array."""
+    coordinates = np.fromiter(
+        itertools.chain.from_iterable(
+            (lat_lng["lat"], lat_lng["lng"]) for lat_lng in geometry
+        ),
+        dtype=np.float64,
+        count=2 * len(geometry),
+    )
+    return coordinates.reshape(-1, 2)
+
+
 def check_file_type(uploaded_file):
     """Check uploaded file has an acceptable file extension."""
     return Path(uploaded_file.filename).suffix in UPLOAD_EXTENSIONS
 
 
 @lru_cache(maxsize=1)
-def database():
-    """Get the running database to be used."""
-    mode = os.environ.get("RUNNING_APP_MODE", "DEV").upper()
-    if mode == "PROD":
+def preprocessing_executor() -> ProcessPoolExecutor:
+    """Processes to preprocess run areas in, created on first use.
+
+    Preprocessing takes minutes of CPU, so is kept out of the server process.
+    Workers are spawned rather than forked, as a fork of the threaded server can
+    inherit a lock held by another thread and deadlock on it.
+    """
+    return ProcessPoolExecutor(
+        max_workers=PREPROCESSING_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+@app.on_event("shutdown")
+def shutdown_preprocessing_executor():
+    if preprocessing_executor.cache_info().currsize:
+        preprocessing_executor().shutdown(wait=False)
+
+
+def open_database() -> RunningDatabase:
+    """Open the running database to be used."""
+    if APP_MODE == "PROD":
         db = RunningDatabase(name="running", clean=False)
     else:
         db = RunningDatabase(name="running_dev", clean=True)
     return db
 
 
+_database: Optional[RunningDatabase] = None
+
+
+@app.on_event("startup")
+def open_database_on_startup():
+    global _database
+    if _database is None:
+        _database = open_database()
+
+
+async def database() -> RunningDatabase:
+    """Get the running database to be used.
+
+    Every request depends on this, so it is a coroutine to skip a trip to the
+    threadpool, and just returns the database opened on startup.
+    """
+    global _database
+    if _database is None:
+        # the app is being used without having been started up
+        _database = open_database()
+    return _database
+
+
 @app.exception_handler(401)
 async def custom_401_handler(*args, **kwargs):
     """Redirect unauthenticated user to the login page."""
     return RedirectResponse("/login")
 
 
-async def get_current_user(
-    token: str = Depends(auth.oauth2_scheme), db: RunningDatabase = Depends(database)
-):
-    """Try to get the current user's details if they have a valid token in header/cookie."""
-    credentials_exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    """Error for when the current user can't be identified."""
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
     )
+
+
+def get_token_username(token: str = Depends(auth.oauth2_scheme)) -> str:
+    """Get the username from a valid token in header/cookie."""
     try:
-        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+        payload = auth.verify_access_token(token)
         username: str = payload.get("sub")
         if username is None:
-            raise credentials_exception
+            raise credentials_exception()
         token_data = models.User(username=username)
-    except (AttributeError, JWTError):
-        raise credentials_exception
+    except jwt.PyJWTError:
+        raise credentials_exception()
+    return token_data.username
+
 
-    user = db.get_user(username=token_data.username)
+def get_current_user(
+    username: str = Depends(get_token_username),
+    db: RunningDatabase = Depends(database),
+):
+    """Try to get the current user's details if they have a valid token in header/cookie."""
+    user = db.get_user(username=username)
     if user is None:
-        raise credentials_exception
+        raise credentials_exception()
     return user
 
 
+def get_current_user_context(
+    username: str = Depends(get_token_username),
+    db: RunningDatabase = Depends(database),
+):
+    """Like `get_current_user`, but also loads the user's run areas with artifacts."""
+    user_context = db.get_user_context(username, artifacts_exist=True)
+    if user_context is None:
+        raise credentials_exception()
+    return user_context
+
+
+def segment_edges(graph: MultiDiGraph) -> Dict[str, List[Tuple[int, int, int]]]:
+    """Edges of a graph by their segment id, built once per loaded graph."""
+    edges_by_segment = graph.graph.get(SEGMENT_EDGES_KEY)
+    if edges_by_segment is None:
+        edges_by_segment = defaultdict(list)
+        for u, v, key, segment_id in graph.edges(keys=True, data="segment_id"):
+            edges_by_segment[segment_id].append((u, v, key))
+        edges_by_segment = graph.graph[SEGMENT_EDGES_KEY] = dict(edges_by_segment)
+    return edges_by_segment
+
+
+def edge_lengths(graph: MultiDiGraph) -> Dict[Tuple[int, int], float]:
+    """Length of the first edge between each pair of nodes.
+
+    Built once per loaded graph. As for `routing_matrix`, views of a graph share its
+    attributes but may hide edges, so the lengths are built afresh for them.
+    """
+    lengths = graph.graph.get(EDGE_LENGTHS_KEY)
+    if lengths is not None and not is_frozen(graph):
+        return lengths
+
+    lengths = {
+        (u, v): length
+        for u, v, key, length in graph.edges(keys=True, data="length")
+        if key == 0
+    }
+    if not is_frozen(graph):
+        graph.graph[EDGE_LENGTHS_KEY] = lengths
+    return lengths
+
+
+def routing_matrix(graph: MultiDiGraph) -> Tuple[List[int], Dict[int, int], csr_matrix]:
+    """Nodes of a graph, their indices and its sparse adjacency matrix of lengths.
+
+    Built once per loaded graph. Views of a graph share its attributes but may hide
+    edges, so the matrix is built afresh for them.
+    """
+    matrix = graph.graph.get(ROUTING_MATRIX_KEY)
+    if matrix is not None and not is_frozen(graph):
+        return matrix
+
+    nodes = list(graph)
+    indices = {node: index for index, node in enumerate(nodes)}
+    # as for networkx, parallel edges are traversed by the shortest
+    lengths: Dict[Tuple[int, int], float] = {}
+    for u, v, length in graph.edges(data="length"):
+        edge = (indices[u], indices[v])
+        lengths[edge] = min(length, lengths.get(edge, length))
+    rows, columns = zip(*lengths) if lengths else ((), ())
+    adjacency = csr_matrix(
+        (list(lengths.values()), (rows, columns)), shape=(len(nodes), len(nodes))
+    )
+    matrix = (nodes, indices, adjacency)
+    if not is_frozen(graph):
+        graph.graph[ROUTING_MATRIX_KEY] = matrix
+    return matrix
+
+
+def index_routing_graph(graph: MultiDiGraph) -> None:
+    """Build the indices used when routing, so they are stored with the graph."""
+    segment_edges(graph)
+    edge_lengths(graph)
+    routing_matrix(graph)
+
+
 def get_routing_graph(current_user: Dict, db: RunningDatabase, respect_ignored=False):
     """Load the graph for routing for the current user and area."""
     run_area = current_user.make_run_area()
     graph = db.get_run_area_graph(current_user.username, current_user.active_area_name)
 
     if respect_ignored:
-        ignored_segment_ids = db.ignored_segment_ids(run_area)
-        to_remove = []
-        for u, v, data in graph.edges(data=True):
-            if data.get("segment_id") in ignored_segment_ids:
-                to_remove.append((u, v))
-
-        graph.remove_edges_from(to_remove)
+        # deduplicated so no segment's edges are listed for removal twice
+        ignored_segment_ids = set(db.ignored_segment_ids(run_area))
+        edges_by_segment = segment_edges(graph)
+        to_remove = [
+            edge
+            for segment_id in ignored_segment_ids
+            for edge in edges_by_segment.get(segment_id, ())
+        ]
+
+        if to_remove:
+            # the loaded graph is cached and shared, so hide edges in a view of it
+            graph = restricted_view(graph, nodes=[], edges=to_remove)
 
     return graph
 
@@ -123,7 +334,7 @@ async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: RunningDatabase = Depends(database),
 ):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+    user = await auth.authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -132,7 +343,9 @@ async def login_for_access_token(
         )
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username},
+        expires_delta=access_token_expires,
+        _mutate=True,
     )
 
     # need 303 to redirect correctly + post method on / path
@@ -158,7 +371,7 @@ def login(request: Request):
 
 
 @app.post("/register")
-async def login_for_access_token(
+def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: RunningDatabase = Depends(database),
 ):
@@ -174,7 +387,7 @@ async def login_for_access_token(
 
 
 @app.post("/set_active_area")
-async def set_active_area(
+def set_active_area(
     run_area: models.SwitchingRunArea,
     db: RunningDatabase = Depends(database),
 ):
@@ -210,13 +423,13 @@ def map_update(
     return templates.TemplateResponse("update.html", {"request": request})
 
 
-@app.get("/current_user_areas", response_model=List[models.RunArea])
+@app.get("/current_user_areas")
 def map_update(
-    current_user: models.CurrentUser = Depends(get_current_user),
-    db: RunningDatabase = Depends(database),
+    user_context: models.UserContext = Depends(get_current_user_context),
 ):
     """Page for updating which roads are considered part of the map."""
-    return db.get_areas_for_user(current_user.username, artifacts_exist=True)
+    # areas were validated when loaded, so skip a response model validating again
+    return [run_area.dict() for run_area in user_context.run_areas]
 
 
 @app.get("/current_username")
@@ -328,18 +541,47 @@ def runs_in_date_range(
         /runs
     """
     run_area = current_user.make_run_area()
-    return db.runs_in_date_range(run_area, start_date=start_date, end_date=end_date)
+    runs = db.runs_in_date_range(
+        run_area, start_date=start_date, end_date=end_date, stream=True
+    )
+    return stream_json_array(dict(run) for run in runs)
 
 
 def diff_in_days(start_date: str, end_date: str) -> int:
     """Difference in days between two dates.
 
-    Expected format is YYYY-MM-DD although this will work with other formats
+    Expected format is YYYY-MM-DD although this will work with other ISO formats
     as long as time zones are the same if present.
     """
     assert start_date <= end_date
-    secs_diff = (pd.Timestamp(end_date) - pd.Timestamp(start_date)).total_seconds()
-    return int(secs_diff / (60 * 60 * 24))
+    try:
+        diff = date.fromisoformat(end_date) - date.fromisoformat(start_date)
+    except ValueError:
+        # includes a time
+        diff = datetime.fromisoformat(end_date) - datetime.fromisoformat(start_date)
+    return int(diff.total_seconds() / (60 * 60 * 24))
+
+
+def animation_frames(traversals: Iterable[sqlite3.Row]) -> Iterator[Dict]:
+    """Group traversals in date order into runs, with the wait until the next."""
+    runs = (
+        (date, rows_to_dicts(run))
+        for date, run in itertools.groupby(traversals, key=itemgetter("date"))
+    )
+    previous = next(runs, None)
+    if previous is None:
+        return
+    for date, run in runs:
+        previous_date, previous_run = previous
+        yield {
+            "date": previous_date,
+            "diff_days": diff_in_days(previous_date, date),
+            "run": previous_run,
+        }
+        previous = (date, run)
+    last_date, last_run = previous
+    # nothing to wait for after last run
+    yield {"date": last_date, "diff_days": 0, "run": last_run}
 
 
 @app.get("/runs_for_animation")
@@ -352,39 +594,9 @@ def runs_for_animation(
     """Runs in time order ready for animation."""
     run_area = current_user.make_run_area()
     traversals = db.runs_in_date_range(
-        run_area, start_date=start_date, end_date=end_date
+        run_area, start_date=start_date, end_date=end_date, stream=True
     )
-    if not traversals:
-        return []
-
-    runs_by_date = []
-    current_date = None
-    current_run = []
-    for traversal in traversals:
-        if current_date is None:
-            current_date = traversal["date"]
-            current_run.append(traversal)
-        elif current_date == traversal["date"]:
-            current_run.append(traversal)
-        else:
-            runs_by_date.append(
-                {
-                    "date": current_date,
-                    "diff_days": diff_in_days(current_date, traversal["date"]),
-                    "run": current_run,
-                }
-            )
-            current_date = traversal["date"]
-            current_run = [traversal]
-
-    runs_by_date.append(
-        {
-            "date": current_date,
-            "diff_days": 0,  # nothing to wait for after last run
-            "run": current_run,
-        }
-    )
-    return runs_by_date
+    return stream_json_array(animation_frames(traversals))
 
 
 @app.get("/first_seen")
@@ -396,26 +608,15 @@ def first_seen(
 ):
     """For each segment covered, find the first date on which it was traversed."""
     run_area = current_user.make_run_area()
-    first_traversals = db.first_seen(run_area, start_date=start_date, end_date=end_date)
-    if not first_traversals:
-        return {}
-
-    first_seen_by_date = {}
-    current_date = None
-    current_segments = []
-    for traversal in first_traversals:
-        if current_date is None:
-            current_date = traversal["date"]
-            current_segments.append(traversal["segment_id"])
-        elif current_date == traversal["date"]:
-            current_segments.append(traversal["segment_id"])
-        else:
-            first_seen_by_date[current_date] = current_segments
-            current_date = traversal["date"]
-            current_segments = [traversal["segment_id"]]
-
-    first_seen_by_date[current_date] = current_segments
-    return first_seen_by_date
+    first_traversals = db.first_seen(
+        run_area, start_date=start_date, end_date=end_date, stream=True
+    )
+    return stream_json_object(
+        (date, [traversal["segment_id"] for traversal in traversals])
+        for date, traversals in itertools.groupby(
+            first_traversals, key=itemgetter("date")
+        )
+    )
 
 
 @app.get("/traversals")
@@ -439,9 +640,10 @@ def traversals_in_date_range(
         /traversals
     """
     run_area = current_user.make_run_area()
-    return db.number_of_traversals_in_date_range(
+    traversals = db.number_of_traversals_in_date_range(
         run_area, start_date=start_date, end_date=end_date
     )
+    return rows_to_dicts(traversals)
 
 
 def distance_at_end_of_segment(
@@ -453,8 +655,53 @@ def distance_at_end_of_segment(
     return distance_along_segment_metres > segment_length_metres * proportion_threshold
 
 
+def shortest_path_between(
+    graph: MultiDiGraph, sources: Dict[int, float], targets: Dict[int, float]
+) -> Tuple[float, List[int]]:
+    """Length and nodes of the shortest path from any source to any target node.
+
+    Paths cost that of their source node to start and that of their target node to
+    finish. Distances from each source are found by scipy's compiled Dijkstra over
+    the graph's routing matrix, then the best combination of ends is picked.
+
+    Raises
+    ------
+    networkx.NetworkXNoPath
+        If there is no path from any source to any target.
+    """
+    nodes, indices, adjacency = routing_matrix(graph)
+    source_nodes = [node for node in sources if node in indices]
+    target_nodes = [node for node in targets if node in indices]
+    if not source_nodes or not target_nodes:
+        raise NetworkXNoPath(f"No path between {list(sources)} and {list(targets)}")
+
+    distances, predecessors = dijkstra(
+        adjacency,
+        indices=[indices[node] for node in source_nodes],
+        return_predecessors=True,
+    )
+    target_indices = [indices[node] for node in target_nodes]
+    lengths = (
+        distances[:, target_indices]
+        + np.array([sources[node] for node in source_nodes])[:, np.newaxis]
+        + np.array([targets[node] for node in target_nodes])
+    )
+    source_position, target_position = np.unravel_index(
+        np.argmin(lengths), lengths.shape
+    )
+    min_length_metres = lengths[source_position, target_position]
+    if not np.isfinite(min_length_metres):
+        raise NetworkXNoPath(f"No path between {list(sources)} and {list(targets)}")
+
+    # walk back from the target until reaching the source, marked by a negative
+    path = [target_indices[target_position]]
+    while predecessors[source_position, path[-1]] >= 0:
+        path.append(predecessors[source_position, path[-1]])
+    return float(min_length_metres), [nodes[index] for index in reversed(path)]
+
+
 @app.post("/route")
-async def route(
+def route(
     snap_data: models.SnapDataForRouting,
     db: RunningDatabase = Depends(database),
     current_user: models.CurrentUser = Depends(get_current_user),
@@ -483,22 +730,24 @@ async def route(
         )
         return {"route": [segment.dict()]}
 
-    from_segment_nodes = {
-        snap_data.from_segment_start_node,
-        snap_data.from_segment_end_node,
-    }
-    to_segment_nodes = {snap_data.to_segment_start_node, snap_data.to_segment_end_node}
-
-    from_segment_length_metres = graph[snap_data.from_segment_start_node][
-        snap_data.from_segment_end_node
-    ][0]["length"]
-    to_segment_length_metres = graph[snap_data.to_segment_start_node][
-        snap_data.to_segment_end_node
-    ][0]["length"]
-
-    common_nodes = from_segment_nodes.intersection(to_segment_nodes)
-    if common_nodes:
-        common_node = common_nodes.pop()
+    lengths = edge_lengths(graph)
+    from_segment_length_metres = lengths[
+        (snap_data.from_segment_start_node, snap_data.from_segment_end_node)
+    ]
+    to_segment_length_metres = lengths[
+        (snap_data.to_segment_start_node, snap_data.to_segment_end_node)
+    ]
+
+    # segments sharing a node, compared directly as there are only two ends each
+    to_segment_nodes = (snap_data.to_segment_start_node, snap_data.to_segment_end_node)
+    if snap_data.from_segment_start_node in to_segment_nodes:
+        common_node = snap_data.from_segment_start_node
+    elif snap_data.from_segment_end_node in to_segment_nodes:
+        common_node = snap_data.from_segment_end_node
+    else:
+        common_node = None
+
+    if common_node is not None:
         route = []
 
         from_segment_to_end = common_node == snap_data.from_segment_end_node
@@ -549,110 +798,57 @@ async def route(
             )
         return {"route": [segment.dict() for segment in route]}
 
-    # want to the true shortest paths, so try all pairs of nodes
-    node_pairs = [
-        (
-            snap_data.from_segment_start_node,
-            snap_data.to_segment_start_node,
-            {
-                "start_distance_metres": snap_data.from_segment_distance_along_segment_metres,
-                "end_distance_metres": 0.0,
-                "starts_at_end": False,
-                "ends_at_end": False,
-            },
-            {
-                "start_distance_metres": 0.0,
-                "end_distance_metres": snap_data.to_segment_distance_along_segment_metres,
-                "starts_at_end": False,
-                "ends_at_end": False,
-            },
-        ),
-        (
-            snap_data.from_segment_start_node,
-            snap_data.to_segment_end_node,
-            {
-                "start_distance_metres": snap_data.from_segment_distance_along_segment_metres,
-                "end_distance_metres": 0.0,
-                "starts_at_end": False,
-                "ends_at_end": False,
-            },
-            {
-                "start_distance_metres": to_segment_length_metres,
-                "end_distance_metres": snap_data.to_segment_distance_along_segment_metres,
-                "starts_at_end": False,
-                "ends_at_end": False,
-            },
-        ),
-        (
-            snap_data.from_segment_end_node,
-            snap_data.to_segment_start_node,
-            {
-                "start_distance_metres": snap_data.from_segment_distance_along_segment_metres,
-                "end_distance_metres": from_segment_length_metres,
-                "starts_at_end": False,
-                "ends_at_end": True,
-            },
-            {
-                "start_distance_metres": 0.0,
-                "end_distance_metres": snap_data.to_segment_distance_along_segment_metres,
-                "starts_at_end": False,
-                "ends_at_end": False,
-            },
-        ),
-        (
-            snap_data.from_segment_end_node,
-            snap_data.to_segment_end_node,
-            {
-                "start_distance_metres": snap_data.from_segment_distance_along_segment_metres,
-                "end_distance_metres": from_segment_length_metres,
-                "starts_at_end": False,
-                "ends_at_end": True,
-            },
-            {
-                "start_distance_metres": to_segment_length_metres,
-                "end_distance_metres": snap_data.to_segment_distance_along_segment_metres,
-                "starts_at_end": False,
-                "ends_at_end": False,
-            },
-        ),
-    ]
-    min_length_metres = float("inf")
-    min_length_path = []
-    min_path_start_segment_data = min_path_end_segment_data = None
-    for source, target, start_segment_data, end_segment_data in node_pairs:
-        try:
-            nodes_in_route = shortest_path(
-                graph,
-                source=source,
-                target=target,
-                weight="length",
-            )
-            edges = list(zip(nodes_in_route, nodes_in_route[1:]))
-
-            # incorporate ending the starting segment and starting the ending segment
-            start_length_metres = abs(
-                start_segment_data["start_distance_metres"]
-                - start_segment_data["end_distance_metres"]
-            )
-            start_length_metres += abs(
-                end_segment_data["start_distance_metres"]
-                - end_segment_data["end_distance_metres"]
-            )
+    # how each segment is traversed depending on which of its ends the path uses
+    start_segment_data_by_node = {
+        snap_data.from_segment_start_node: {
+            "start_distance_metres": snap_data.from_segment_distance_along_segment_metres,
+            "end_distance_metres": 0.0,
+            "starts_at_end": False,
+            "ends_at_end": False,
+        },
+        snap_data.from_segment_end_node: {
+            "start_distance_metres": snap_data.from_segment_distance_along_segment_metres,
+            "end_distance_metres": from_segment_length_metres,
+            "starts_at_end": False,
+            "ends_at_end": True,
+        },
+    }
+    end_segment_data_by_node = {
+        snap_data.to_segment_start_node: {
+            "start_distance_metres": 0.0,
+            "end_distance_metres": snap_data.to_segment_distance_along_segment_metres,
+            "starts_at_end": False,
+            "ends_at_end": False,
+        },
+        snap_data.to_segment_end_node: {
+            "start_distance_metres": to_segment_length_metres,
+            "end_distance_metres": snap_data.to_segment_distance_along_segment_metres,
+            "starts_at_end": False,
+            "ends_at_end": False,
+        },
+    }
 
-            path_length_metres = start_length_metres + sum(
-                graph.edges[(u, v, 0)]["length"] for u, v in edges
-            )
-            if path_length_metres < min_length_metres:
-                min_length_metres = path_length_metres
-                min_length_path = edges
-                min_path_start_segment_data = start_segment_data
-                min_path_end_segment_data = end_segment_data
-        except Exception as e:
-            pass
+    # want the true shortest path, so search from both ends of the starting segment
+    # to both ends of the ending segment at once, including the partial segments
+    sources = {
+        node: abs(data["start_distance_metres"] - data["end_distance_metres"])
+        for node, data in start_segment_data_by_node.items()
+    }
+    targets = {
+        node: abs(data["start_distance_metres"] - data["end_distance_metres"])
+        for node, data in end_segment_data_by_node.items()
+    }
+    try:
+        _, nodes_in_route = shortest_path_between(graph, sources, targets)
+    except NetworkXNoPath:
+        nodes_in_route = []
+    min_length_path = list(zip(nodes_in_route, nodes_in_route[1:]))
 
     # no path for any node pairing between the segments we're routing between
     if not min_length_path:
         return {"route": []}
+    min_path_start_segment_data = start_segment_data_by_node[nodes_in_route[0]]
+    min_path_end_segment_data = end_segment_data_by_node[nodes_in_route[-1]]
 
     # start segment
     route = [
@@ -663,12 +859,14 @@ async def route(
 
     # intermediate segments, which must exist since we did the 2 segment route
     # case earlier
-    for start_node, end_node in min_length_path:
+    lengths = edge_lengths(graph)
+    for edge in min_length_path:
+        start_node, end_node = edge
         route.append(
             models.FullSegmentTraversal(
                 start_node=start_node,
                 end_node=end_node,
-                length_metres=graph.edges[(start_node, end_node, 0)]["length"],
+                length_metres=lengths[edge],
             )
         )
 
@@ -685,14 +883,27 @@ async def route(
 def uploaded_runs(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    min_lat: Optional[float] = None,
+    min_lng: Optional[float] = None,
+    max_lat: Optional[float] = None,
+    max_lng: Optional[float] = None,
     db: RunningDatabase = Depends(database),
     current_user: models.CurrentUser = Depends(get_current_user),
 ):
-    """Retrieve uploaded runs stored in the database in a date range."""
+    """Retrieve uploaded runs stored in the database in a date range.
+
+    Optionally only those which could intersect a bounding box, e.g. the viewport.
+    """
     run_area = current_user.make_run_area()
-    return db.uploaded_runs_in_date_range(
-        run_area, start_date=start_date, end_date=end_date
+    bbox = (min_lat, min_lng, max_lat, max_lng)
+    runs = db.uploaded_runs_in_date_range(
+        run_area,
+        start_date=start_date,
+        end_date=end_date,
+        bbox=None if None in bbox else bbox,
+        stream=True,
     )
+    return stream_json_array(dict(run) for run in runs)
 
 
 @app.get("/run_area", response_class=HTMLResponse)
@@ -704,7 +915,7 @@ def run_area(
 
 
 @app.get("/geometry")
-async def get_run_area_geometry(
+def get_run_area_geometry(
     db: RunningDatabase = Depends(database),
     current_user: models.CurrentUser = Depends(get_current_user),
 ):
@@ -721,19 +932,16 @@ def retrieve_graph_and_geometry(
     has_active_area: bool = False,
 ):
     """Get OSM graph and geometry data for the area selected."""
+    lat_lngs = lat_lng_array(run_area_geometry.geometry)
     # when using osmnx we need (x, y) coordinates
-    points = [
-        (lat_lng["lng"], lat_lng["lat"]) for lat_lng in run_area_geometry.geometry
-    ]
-    polygon = Polygon(points)
+    polygon = Polygon(lat_lngs[:, ::-1])
     logger.info(f"Preprocessing running network area {run_area_geometry.area_name}")
-    output = preprocess_running_network(polygon)
+    # this background task waits in its thread while the work is done elsewhere
+    future = preprocessing_executor().submit(preprocess_running_network, polygon)
+    output = future.result()
     logger.info(f"Got data for area {run_area_geometry.area_name}, saving in database")
 
     # confusingly we store the polygon in WKT format with (lat, lng) coordinates
-    lat_lngs = [
-        (lat_lng["lat"], lat_lng["lng"]) for lat_lng in run_area_geometry.geometry
-    ]
     run_area_polygon = Polygon(lat_lngs)
     run_area = models.RunArea(
         username=username,
@@ -741,8 +949,10 @@ def retrieve_graph_and_geometry(
         polygon=run_area_polygon.wkt,
         active=False,
     )
+    graph = json_graph.node_link_graph(output["graph"])
+    index_routing_graph(graph)
     db.insert_run_area(run_area)
-    db.insert_run_area_graph(username, run_area.area_name, output["graph"])
+    db.insert_run_area_graph(username, run_area.area_name, graph)
     db.insert_run_area_geometry(username, run_area.area_name, output["geometry"])
 
     if not has_active_area:
@@ -773,7 +983,7 @@ async def create_run_area(
 
 
 @app.post("/remove_run_area")
-async def remove_run_area(
+def remove_run_area(
     run_area: models.RunArea,
     response: Response,
     db: RunningDatabase = Depends(database),
@@ -785,34 +995,35 @@ async def remove_run_area(
 
 
 @app.post("/sub_run_area")
-async def sub_run_area(
+def sub_run_area(
     sub_run_area_name: models.SubRunAreaName,
     db: RunningDatabase = Depends(database),
     current_user: models.CurrentUser = Depends(get_current_user),
-) -> models.SubRunArea:
+) -> Optional[Dict]:
     """Get all data about a sub run area."""
     sub_run_area = models.SubRunArea(
         username=current_user.username,
         area_name=current_user.active_area_name,
         sub_area_name=sub_run_area_name.name,
     )
-    return db.get_sub_run_area(sub_run_area)
+    sub_run_area = db.get_sub_run_area(sub_run_area)
+    return None if sub_run_area is None else sub_run_area.dict()
 
 
 @app.get("/sub_run_areas")
-async def sub_run_areas(
+def sub_run_areas(
     db: RunningDatabase = Depends(database),
     current_user: models.CurrentUser = Depends(get_current_user),
-) -> List[models.SubRunArea]:
+) -> List[Dict]:
     """Get all sub run areas in a run area."""
     run_area = models.BaseRunArea(
         username=current_user.username, area_name=current_user.active_area_name
     )
-    return db.get_sub_run_areas(run_area)
+    return [sub_run_area.dict() for sub_run_area in db.get_sub_run_areas(run_area)]
 
 
 @app.post("/insert_sub_run_area")
-async def insert_sub_run_area(
+def insert_sub_run_area(
     sub_run_area_geometry: models.SubRunAreaGeometry,
     response: Response,
     db: RunningDatabase = Depends(database),
@@ -821,9 +1032,7 @@ async def insert_sub_run_area(
     """Store a sub run area."""
 
     # convert from a list of lat lngs to a WKT representation
-    lat_lngs = [
-        (lat_lng["lat"], lat_lng["lng"]) for lat_lng in sub_run_area_geometry.geometry
-    ]
+    lat_lngs = lat_lng_array(sub_run_area_geometry.geometry)
     sub_run_area_polygon = Polygon(lat_lngs).wkt
 
     sub_run_area = models.SubRunArea(
@@ -840,7 +1049,7 @@ async def insert_sub_run_area(
 
 
 @app.post("/remove_sub_run_area")
-async def remove_sub_run_area(
+def remove_sub_run_area(
     sub_run_area: models.SubRunArea,
     response: Response,
     db: RunningDatabase = Depends(database),
@@ -852,7 +1061,7 @@ async def remove_sub_run_area(
 
 
 @app.post("/upload_run")
-async def upload_run(
+def upload_run(
     response: Response,
     uploaded_file: UploadFile = File(...),
     db: RunningDatabase = Depends(database),
@@ -864,9 +1073,9 @@ async def upload_run(
         response.status_code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
         return
 
-    raw_xml = await uploaded_file.read()
     try:
-        linestring = gps_utils.parse_tcx_file(raw_xml)
+        # stream from the spooled upload rather than reading it all into memory
+        linestring = gps_utils.parse_tcx_file(uploaded_file.file)
         response.status_code = status.HTTP_200_OK
         return {"linestring": linestring}
     except gps_utils.XMLParsingError as e:
@@ -875,7 +1084,15 @@ async def upload_run(
 
 
 if __name__ == "__main__":
-    mode = os.environ.get("RUNNING_APP_MODE", "DEV").upper()
     # only reload on changes in DEV mode
-    reload = mode == "DEV"
-    uvicorn.run("main:app", host="0.0.0.0", port=1234, reload=reload)
+    reload = APP_MODE == "DEV"
+    # named explicitly so a missing uvloop or httptools fails rather than falling
+    # back to the slower pure python implementations
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=1234,
+        reload=reload,
+        loop="uvloop",
+        http="httptools",
+    )
@@ -1,9 +1,18 @@
 """Models used in the app.
 """
 from datetime import datetime
+import re
 from typing import Dict, List, Optional
 
-from pydantic import BaseModel, ValidationError, validator
+from pydantic import BaseModel, validator
+
+# 'LINESTRING(lat_1 lng_1, lat_2 lng_2, ...)', where parsed runs omit the spaces
+# after commas
+_NUMBER = r"-?\d+(?:\.\d+)?(?:e[-+]?\d+)?"
+_COORDINATE = f"{_NUMBER} {_NUMBER}"
+WKT_LINESTRING_PATTERN = re.compile(
+    rf"LINESTRING\({_COORDINATE}(?:, ?{_COORDINATE})*\)"
+)
 
 
 def date_validation(date: str):
@@ -11,13 +20,30 @@ def date_validation(date: str):
     valid_example = "2021-06-01"
     message = f"dates should have format YYYY-MM-DD, e.g. '{valid_example}'. "
     if len(date) != len(valid_example):
-        raise ValidationError(message + f"Length was not {len(valid_example)}")
+        raise ValueError(message + f"Length was not {len(valid_example)}")
+    # newer Pythons parse other ISO 8601 forms too, e.g. week dates
+    if date[4] != "-" or date[7] != "-":
+        raise ValueError(message)
 
     try:
-        datetime.strptime(date, "%Y-%m-%d")
+        datetime.fromisoformat(date)
         return date
     except ValueError:
-        raise ValidationError(message)
+        raise ValueError(message)
+
+
+def linestring_validation(linestring: Optional[str]) -> Optional[str]:
+    """Valid linestrings have format 'LINESTRING(lat_1 lng_1, lat_2 lng_2, ...)'."""
+    if linestring is None:
+        # should only occur for migration of old v1 schema data to v2 schema
+        return linestring
+
+    if WKT_LINESTRING_PATTERN.fullmatch(linestring) is None:
+        raise ValueError(
+            "linestrings should have format "
+            "'LINESTRING(lat_1 lng_1, lat_2 lng_2, ...)'"
+        )
+    return linestring
 
 
 class SegmentList(BaseModel):
@@ -47,34 +73,7 @@ class SegmentCollection(BaseModel):
     segment_ids: List[str]
 
 
-class ValidationMixin:
-    """Common validation across models."""
-
-    @validator("date")
-    def date_must_have_correct_format(cls, v):
-        """Validate format of date field."""
-        return date_validation(v)
-
-    @validator("linestring")
-    def linestring_must_have_correct_format(cls, v):
-        """Validate format of linestring field.
-
-        format is 'LINESTRING(lat_1 lng_1, lat_2 lng_2, ...)'.
-        """
-        if v is None:
-            # should only occur for migration of old v1 schema data to v2 schema
-            return True
-
-        correct_start = v.startswith("LINESTRING(")
-        correct_end = v.endswith(")")
-        num_commas = len([char for char in v if char == ","])
-        num_spaces = len([char for char in v if char == " "])
-        # one space per lat-lng, then one between each coord
-        expected_punctuation = 2 * num_commas + 1 == num_spaces
-        return all([correct_start, correct_end, expected_punctuation])
-
-
-class LoggedRun(BaseModel, ValidationMixin):
+class LoggedRun(BaseModel):
     """A run to log towards the challenge.
 
     Currently only a single run per day is supported.
@@ -106,6 +105,11 @@ class LoggedRun(BaseModel, ValidationMixin):
     allow_multiple: bool
     segment_traversals: Dict[str, int]
 
+    _validate_date = validator("date", allow_reuse=True)(date_validation)
+    _validate_linestring = validator("linestring", allow_reuse=True)(
+        linestring_validation
+    )
+
 
 class BaseRunArea(BaseModel):
     """Basic named run area for a user."""
@@ -175,6 +179,9 @@ class SnapDataForRouting(BaseModel):
     to_segment_start_node: int
     to_segment_end_node: int
 
+    class Config:
+        frozen = True
+
 
 class SegmentTraversal(BaseModel):
     """Partial traversal of a segment found during routing."""
@@ -185,6 +192,9 @@ class SegmentTraversal(BaseModel):
     starts_at_end: bool
     ends_at_end: bool
 
+    class Config:
+        frozen = True
+
 
 class FullSegmentTraversal(BaseModel):
     """A segment fully traversed as part of routing on the network."""
@@ -193,8 +203,11 @@ class FullSegmentTraversal(BaseModel):
     end_node: int
     length_metres: float
 
+    class Config:
+        frozen = True
+
 
-class RunV1(BaseModel, ValidationMixin):
+class RunV1(BaseModel):
     """Initial model reflecting `run` table schema.
 
     Only needed for migration from earlier app version.
@@ -203,6 +216,8 @@ class RunV1(BaseModel, ValidationMixin):
     date: str
     segment_id: str
 
+    _validate_date = validator("date", allow_reuse=True)(date_validation)
+
 
 class UploadedRunV1(BaseModel):
     """Initial model reflecting `uploaded_run` table schema.
@@ -245,6 +260,21 @@ class CurrentUser(User):
         return run_area
 
 
+class UserContext(BaseModel):
+    """A user along with their run areas, loaded together.
+
+    Attributes
+    ----------
+    user: CurrentUser
+        The user, including their active area if they have one.
+    run_areas: list[RunArea]
+        The user's run areas.
+    """
+
+    user: CurrentUser
+    run_areas: List[RunArea]
+
+
 class RunAreaGeometry(BaseModel):
     """User drawn/uploaded geometry with which to create new run area."""
 
@@ -1,10 +1,12 @@
 """Retrieval and pre-processing of OSM data.
 """
-import json
+from functools import lru_cache
+import os
 from typing import Any, Dict, List, Optional, Set, Union
 
 import geopandas as gpd
 import networkx as nx
+import numpy as np
 import osmnx as ox
 import shapely
 
@@ -27,90 +29,117 @@ def simplify_graph(graph, tolerance_m: float = 10.0, project_crs: int = 27700):
     return ox.projection.project_graph(simplified_projected_graph, to_crs=4326)
 
 
-def clean_osm_ids(osm_id: Union[str, int, List[int], List[str]]) -> str:
-    """Clean up OSM ids from OSMnx.
-
-    Describe here (list if ways joined as no junction).
-    Still have multiple occurences for junction to junction parts.
-    """
-    if isinstance(osm_id, str):
-        return osm_id
-    if isinstance(osm_id, int):
-        return str(osm_id)
-    else:
-        return "_".join([str(id) for id in osm_id])
+def join_osm_ids(osm_ids: Union[List[int], List[str]]) -> str:
+    """Join the ids of OSM ways which OSMnx merged as there was no junction."""
+    return "_".join(map(str, osm_ids))
 
 
 def assign_segment_ids(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Assign correct segment ids given original OSM way ids from OSMnx."""
-    df["segment_id"] = df.segment_id.apply(clean_osm_ids)
-    # add suffix to distinguish junction to junction pieces
+    """Assign correct segment ids given original OSM way ids from OSMnx.
+
+    Ids are single way ids, or lists of them where ways were merged. Single ids
+    are converted in one vectorised pass, so only lists are handled per row.
+    """
+    # object dtype, so integer ids can be replaced by strings in place
+    segment_ids = df.segment_id.astype(object)
+    is_list = segment_ids.map(type).eq(list)
+    segment_ids[~is_list] = segment_ids[~is_list].astype(str)
+    segment_ids[is_list] = segment_ids[is_list].map(join_osm_ids)
+    # still have multiple occurences for junction to junction parts, so add suffix
+    # to distinguish them
     df["segment_id"] = (
-        df.segment_id + "_" + df.groupby("segment_id").cumcount().astype(str)
+        segment_ids + "_" + segment_ids.groupby(segment_ids).cumcount().astype(str)
     )
     return df
 
 
 def remove_motorways(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """Remove motorway segments."""
-    motorways = df.ref.str.contains("M").fillna(False)
+    # motorway refs can also end in M, e.g. "A1(M)", so match anywhere
+    motorways = df.ref.str.contains("M", regex=False, na=False)
     return df[~motorways].drop("ref", axis=1)
 
 
+@lru_cache(maxsize=32)
+def _read_shape_file(shape_file_path: str, mtime: float) -> gpd.GeoDataFrame:
+    """Read a shape file in lat-lngs, cached until the file is modified."""
+    return gpd.read_file(shape_file_path).to_crs(4326)
+
+
 def filter_to_within_shape_file_polygon(
     segment_gdf: gpd.GeoDataFrame, shape_file_path: str
 ) -> gpd.GeoDataFrame:
     """Subset the data to within the polygon in the shape file."""
-    shape_file_gdf = gpd.read_file(shape_file_path).to_crs(4326)
-    return gpd.overlap(segment_gdf, shape_file_gdf, how="intersection")
+    shape_file_gdf = _read_shape_file(
+        shape_file_path, os.path.getmtime(shape_file_path)
+    )
+    return gpd.overlay(segment_gdf, shape_file_gdf, how="intersection")
 
 
 def filter_highway_tags(
     df: gpd.GeoDataFrame, highway_tags_to_filter: Optional[Set[str]] = None
 ) -> gpd.GeoDataFrame:
-    """Remove segments with any of the given highway tags."""
-    if highway_tags_to_filter is None:
-        highway_tags_to_filter = set()
-    tag_mask = df.highway.apply(
-        lambda x: any(tag in x for tag in highway_tags_to_filter)
-    )
-    return df[~tag_mask]
+    """Remove segments with any of the given highway tags.
+
+    A segment's tags are a single tag, or a list of them where ways were merged.
+    """
+    if not highway_tags_to_filter:
+        return df
+
+    # edges are indexed by (u, v, key), so match tags back to segments by position
+    tags = df.highway.reset_index(drop=True).explode()
+    tag_mask = tags.isin(highway_tags_to_filter).groupby(level=0).any()
+    return df[~tag_mask.to_numpy()]
 
 
 def make_sure_geometries_agree_with_start_end_nodes(graph, geometry) -> Dict[str, Any]:
-    """Geojson segment coordinates should go from start node -> end node."""
-    features = []
-    for feature in geometry["features"]:
-        start_node = feature["properties"]["start_node"]
-        end_node = feature["properties"]["end_node"]
+    """Geojson segment coordinates should go from start node -> end node.
 
+    Which end of each geometry is at its start node is decided for all features at
+    once, by comparing arrays of co-ordinates.
+    """
+    node_indices = {node: index for index, node in enumerate(graph)}
+    node_lng_lats = np.array(
+        [(data["x"], data["y"]) for _, data in graph.nodes(data=True)],
+        dtype=np.float64,
+    ).reshape(-1, 2)
+    all_features = geometry["features"]
+    start_lng_lats = node_lng_lats[
+        [node_indices[feature["properties"]["start_node"]] for feature in all_features]
+    ]
+    first_lng_lats = np.array(
+        [feature["geometry"]["coordinates"][0] for feature in all_features],
+        dtype=np.float64,
+    ).reshape(-1, 2)
+    last_lng_lats = np.array(
+        [feature["geometry"]["coordinates"][-1] for feature in all_features],
+        dtype=np.float64,
+    ).reshape(-1, 2)
+    equals_start_of_geom = (first_lng_lats == start_lng_lats).all(axis=1)
+    # geometries starting at the start node are kept as they are
+    equals_end_of_geom = ~equals_start_of_geom & (
+        last_lng_lats == start_lng_lats
+    ).all(axis=1)
+
+    features = []
+    for feature, keep, reverse in zip(
+        all_features, equals_start_of_geom | equals_end_of_geom, equals_end_of_geom
+    ):
+        properties = feature["properties"]
         # assign proper segment id if possible
-        try:
-            graph[start_node][end_node][0]["segment_id"] = feature["properties"][
-                "segment_id"
-            ]
-        except KeyError:
-            pass
-
-        node_props = graph.nodes[start_node]
-        start_node_lng_lat = [node_props["x"], node_props["y"]]
-
-        equals_start_of_geom = (
-            feature["geometry"]["coordinates"][0] == start_node_lng_lat
-        )
-        equals_end_of_geom = (
-            feature["geometry"]["coordinates"][-1] == start_node_lng_lat
+        edge = graph.get_edge_data(
+            properties["start_node"], properties["end_node"], key=0
         )
+        if edge is not None:
+            edge["segment_id"] = properties["segment_id"]
 
-        if not (equals_start_of_geom or equals_end_of_geom):
+        if not keep:
             continue
 
-        if equals_end_of_geom:
-            # need to reverse the geometry
-            feature["geometry"]["coordinates"] = feature["geometry"]["coordinates"][
-                ::-1
-            ]
-
+        if reverse:
+            # need to reverse the geometry, whose co-ordinates are tuples
+            segment_geometry = feature["geometry"]
+            segment_geometry["coordinates"] = segment_geometry["coordinates"][::-1]
         features.append(feature)
 
     geometry["features"] = features
@@ -144,18 +173,20 @@ def preprocess_running_network(
         graph = simplify_graph(graph, **simplify_kwargs)
 
     segment_gdf = ox.utils_graph.graph_to_gdfs(graph, nodes=False, edges=True)
+    # drop the many other OSM tags up front so nothing below has to carry them
+    used_columns = ["osmid", "length", "geometry", "ref", "highway"]
+    segment_gdf = segment_gdf[
+        [column for column in used_columns if column in segment_gdf.columns]
+    ]
     segment_gdf = filter_highway_tags(
         segment_gdf,
         highway_tags_to_filter=highway_tags_to_filter,
     )
-
-    columns = ["osmid", "length", "geometry"]
-    if "ref" in segment_gdf.columns:
-        columns.append("ref")
+    if "highway" in segment_gdf.columns:
+        segment_gdf = segment_gdf.drop("highway", axis=1)
 
     segment_gdf = (
-        segment_gdf[columns]
-        .reset_index()
+        segment_gdf.reset_index()
         .drop("key", axis=1)
         .rename(
             columns={
@@ -170,15 +201,18 @@ def preprocess_running_network(
     if "ref" in segment_gdf.columns:
         segment_gdf = remove_motorways(segment_gdf)
 
-    # to_json returns a string...
-    geometry = json.loads(segment_gdf.to_json())
+    # the same GeoJSON as to_json, without serialising it to a string and back
+    geometry = {
+        "type": "FeatureCollection",
+        "features": list(segment_gdf.iterfeatures(na="null", show_bbox=False)),
+    }
     refined_data = make_sure_geometries_agree_with_start_end_nodes(graph, geometry)
 
     # save the graph minus the geometry
     graph_data = nx.readwrite.json_graph.node_link_data(refined_data["graph"])
-    links = []
+    # links are new dicts rather than the graph's own edge attributes, so can be
+    # changed in place
     for link in graph_data["links"]:
-        links.append({k: v for k, v in link.items() if k != "geometry"})
-    graph_data["links"] = links
+        link.pop("geometry", None)
 
     return {"graph": graph_data, "geometry": refined_data["geometry"]}
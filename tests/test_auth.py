@@ -0,0 +1,32 @@
+"""Tests for the authentication utilities."""
+from pathlib import Path
+import sys
+
+import bcrypt
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import auth  # noqa: E402
+
+
+def _hash(password: str) -> str:
+    # minimum rounds, as the cost factor doesn't matter here
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=4)).decode(
+        "utf-8"
+    )
+
+
+def test_verify_passwords_empty():
+    assert auth.verify_passwords([]) == []
+
+
+def test_verify_passwords_matches_verify_password():
+    pairs = [
+        ("correct horse", _hash("correct horse")),
+        ("battery staple", _hash("something else")),
+        ("pässwörd", _hash("pässwörd")),
+    ]
+    expected = [True, False, True]
+    assert auth.verify_passwords(pairs) == expected
+    assert auth.verify_passwords(pairs, max_workers=1) == expected
+    assert [auth.verify_password(*pair) for pair in pairs] == expected